@@ -23,30 +23,57 @@ Usage:
 
 from __future__ import annotations
 import argparse
+import atexit
+import collections
+import copy
+import functools
+import glob
+import hashlib
+import importlib.util
 import json
 import logging
+import logging.handlers
 import os
+import queue
 import re
 import sys
 import textwrap
 import time
 import traceback
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
 from typing import List, Dict, Any, Tuple, Optional
+from xml.etree import ElementTree
 
 import torch
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
-    TextIteratorStreamer,
+    BitsAndBytesConfig,
+    DynamicCache,
+    GenerationConfig,
 )
 
-# Optional sympy for mathematical validation
+# Optional diskcache for reusing generated responses across runs
 try:
-    import sympy as sp
+    import diskcache
 except Exception:  # pragma: no cover
-    sp = None
+    diskcache = None
+
+# Optional orjson for faster JSON encoding and decoding
+try:
+    import orjson
+except Exception:  # pragma: no cover
+    orjson = None
+
+# Optional RE2 (google-re2) for the linear-time input scanners; patterns passed to it
+# carry their flags inline because its compile() takes options, not re flags
+try:
+    import re2 as _scan_re
+except Exception:  # pragma: no cover
+    _scan_re = re
 
 # Optional manim for animation generation
 try:
@@ -58,6 +85,103 @@ except Exception:  # pragma: no cover
     class Scene:
         pass
 
+# WordprocessingML namespace prefix for .docx element and attribute names
+_W = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
+# Precompiled regular expressions for problem parsing and diagram generation
+_HEADING_RE = _scan_re.compile(r'(?m)^(#{1,6})[^\S\n]+(\S.*)$')
+# A problem fence opening (group "open" holds the fence and its type) or a bare closing fence line
+_FENCE_LINE_RE = _scan_re.compile(
+    r'(?mi)^(?:(?P<open>```(?:problem|math|question)\w*)|[^\S\n]*```[^\S\n]*$)'
+)
+_NUMBERED_LINE_RE = re.compile(r'^\d+\.\s+')
+_INT_RE = re.compile(r'\b\d+\b')
+_NUM_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_BRACKET_MATH_RE = re.compile(r'\[([^\]]+)\]')
+
+# Sentence splitting for solutions without step markers
+_SENTENCE_SPLIT_RE = re.compile(r'[.!?]+')
+
+# Characters kept when cleaning an expression for SymPy (\w, whitespace and operators)
+_SYMPY_DISALLOWED_RE = re.compile(r'[^\w\s\+\-\*/\(\)\^\.\=]')
+_SYMPY_MATHLIKE_RE = re.compile(r'[0-9+\-*/^=]')
+_SYMPY_MAX_SIMPLIFY_OPS = 40
+_SYMPY_ASCII_DELETE = str.maketrans('', '', ''.join(
+    c for c in map(chr, range(128))
+    if not (c.isalnum() or c == '_' or c.isspace() or c in '+-*/()^.=')
+))
+
+# Equation extraction
+_EQ_ASSIGN_RE = re.compile(r'([a-zA-Z0-9\s\+\-\*\/\(\)]+\s*=\s*[a-zA-Z0-9\s\+\-\*\/\(\)]+)')
+_EQ_BRACKET_RE = re.compile(r'[\[\(]([^[\]()]*=+[^[\]()]*?)[\]\)]')
+_EQ_VARIABLE_RE = re.compile(r'([a-zA-Z]\s*[\+\-\*\/]\s*\d+\s*=\s*\d+)')
+
+# Markdown response parsing
+_SECTION_RE = re.compile(r'^\s*(?:##|###)[\s_]*([^#\n]+)', re.MULTILINE)
+_NUMBERED_MAIN_RE = re.compile(r'^(\d+)\.\s*\*\*([^*]+)\*\*:?\s*$', re.MULTILINE)
+# Lines that could be list items: a bullet or "1."-"3." marker, or bold text
+_BULLET_LINE_RE = re.compile(r'^[^\S\n]*(?:[-*] |[123]\. ).*$|^.*\*\*.*$', re.MULTILINE)
+_BULLET_PREFIXES = ('- ', '* ', '1. ', '2. ', '3. ')
+_MISTAKE_EMOJI = '🚫❌⚠️'
+_PRACTICE_EMOJI = '📝✏️📋'
+_COMMON_MISTAKE_BULLET_RE = re.compile(r'^[-*]+\s*\*\*Common mistake:\*\*\s*')
+_BOLD_RE = re.compile(r'\*\*([^*]*)\*\*')
+_BOXED_RE = re.compile(r'\boxed\{([^}]+)\}')
+_FINAL_ANSWER_RE = re.compile(r'(?:\d+\.\s*)?\*\*\s*Final Answer\s*\*\*:?\s*(.*?)(?=\n\s*(?:\d+\.\s*)?\*\*|\n\s*##|\Z)', re.DOTALL | re.IGNORECASE)
+_MISTAKES_SECTION_RE = re.compile(r'##_?common_?mistakes?\s*(.*?)(?=##|\Z)', re.DOTALL | re.IGNORECASE)
+_PRACTICE_SECTION_RE = re.compile(r'##_?practice_?problems?\s*(.*?)(?=##|\Z)', re.DOTALL | re.IGNORECASE)
+_SECTION_START_RE = re.compile(r'^(?:##[\s_]+|\d+\.\s*\*\*)', re.MULTILINE)
+
+# Markdown fallback, manual extraction and JSON construction
+# Each group is one fallback section; a lookahead so overlapping names are all seen
+_FALLBACK_SECTION_RE = re.compile(
+    r'(?=(Overview)|(Solution)|(Final Answer)|(Common Mistakes|Mistakes)|(Practice Problems|Practice))',
+    re.IGNORECASE
+)
+_FALLBACK_SECTIONS = ("overview", "solution", "final_answer", "mistakes", "practice")
+# Payload of a "- item" line, and whole lines carrying a mistake or practice emoji
+_FALLBACK_DASH_ITEM_RE = re.compile(r'^[^\S\n]*- [^\S\n]*(.*\S)', re.MULTILINE)
+_FALLBACK_MISTAKE_LINE_RE = re.compile(r'^.*🚫.*$', re.MULTILINE)
+_FALLBACK_PRACTICE_LINE_RE = re.compile(r'^.*📝.*$', re.MULTILINE)
+_CODEBLOCK_JSON_RE = re.compile(r'```json\s*([\s\S]*?)```')
+_TRAILING_COMMA_OBJ_RE = re.compile(r',\s*}')
+_TRAILING_COMMA_ARR_RE = re.compile(r',\s*]')
+_JSON_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_JSON_ESCAPE_TABLE = str.maketrans({'\n': '\\n', '\t': '\\t'})
+_MANUAL_MISTAKES_RE = re.compile(r'\*\*Common Mistakes:\*\*(.*?)(?=\*\*Practice|\*\*$|$)', re.DOTALL | re.IGNORECASE)
+_MANUAL_PRACTICE_RE = re.compile(r'\*\*Practice Problems?:\*\*(.*?)$', re.DOTALL | re.IGNORECASE)
+_BOLD_SOLUTION_SECTION_RE = re.compile(r'\*\*Step-by-Step Solution:\*\*(.*?)(?=\*\*|$)', re.DOTALL | re.IGNORECASE)
+_BOLD_MISTAKES_SECTION_RE = re.compile(r'\*\*Common Mistakes:\*\*(.*?)(?=\*\*|$)', re.DOTALL | re.IGNORECASE)
+_LIST_NUMBER_RE = re.compile(r'\d+\.')
+_MISTAKE_LABEL_RE = re.compile(r'\*\*Mistake \d+:\*\*')
+_BOLD_PRACTICE_SECTION_RE = re.compile(r'\*\*Practice Problems:\*\*(.*?)(?=\*\*|$)', re.DOTALL | re.IGNORECASE)
+_PRACTICE_LABEL_RE = re.compile(r'\*\*[^\n]*?Problem \d+:\*\*')
+_FINAL_ANSWER_LOC_RE = re.compile(r'final answer', re.IGNORECASE)
+_MANUAL_SOLUTION_RES = tuple(re.compile(pattern, re.DOTALL | re.IGNORECASE) for pattern in (
+    r'\*\*Step-by-Step Solution:\*\*(.*?)(?=\*\*Final Answer|\*\*Common Mistakes|\*\*Practice|$)',
+    r'Step-by-Step Solution:(.*?)(?=Final Answer|Common Mistakes|Practice|$)',
+    r'Solution:(.*?)(?=Answer|Mistakes|Practice|$)',
+))
+_MANUAL_FINAL_ANSWER_RES = tuple(re.compile(pattern, re.IGNORECASE) for pattern in (
+    r'\\boxed\{([^}]+)\}',
+    r'\*\*Final Answer:\*\*\s*\\?\[?\s*\\?boxed\{([^}]+)\}\s*\\?\]?',
+    r'Final Answer:\s*([^\n\*]+)',
+    r'Answer:\s*([^\n\*]+)',
+    r'Therefore,?\s*([^\n\.]+)',
+))
+_CONSTRUCT_FINAL_ANSWER_RES = tuple(re.compile(pattern, re.IGNORECASE) for pattern in (
+    r'\\boxed\{([^}]+)\}',
+    r'\*\*Final Answer:\*\*\s*([^\n\*]+)',
+    r'Final Answer:\s*([^\n\*]+)',
+    r'Answer:\s*([^\n\*]+)',
+))
+
+# Tokens reserved for the chat prompt when sizing the vLLM context window
+_PROMPT_TOKEN_BUDGET = 2048
+
+# Background listener writing queued log records, set by setup_logging
+_log_listener = None
+
 def setup_logging(log_level: str, output_dir: str) -> None:
     """Setup comprehensive logging with file and console handlers."""
     try:
@@ -89,11 +213,20 @@ def setup_logging(log_level: str, output_dir: str) -> None:
         file_handler.setLevel(logging.DEBUG)
         file_handler.setFormatter(detailed_formatter)
         
-        # Configure root logger
+        # Configure root logger; records are handed to a background thread so
+        # console and file writes never block generation or parsing
+        log_queue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(
+            log_queue, console_handler, file_handler, respect_handler_level=True
+        )
+        listener.start()
+        atexit.register(listener.stop)
+        global _log_listener
+        _log_listener = listener
+        
         root_logger = logging.getLogger()
         root_logger.setLevel(logging.DEBUG)
-        root_logger.addHandler(console_handler)
-        root_logger.addHandler(file_handler)
+        root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
         
         logging.info(f"Logging initialized - Level: {log_level}, File: {log_file}")
         
@@ -102,6 +235,16 @@ def setup_logging(log_level: str, output_dir: str) -> None:
         # Fallback to basic logging
         logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+def init_worker_logging() -> None:
+    """Log straight to the parent's handlers in a forked worker, where no queue listener runs."""
+    if _log_listener is not None:
+        logging.getLogger().handlers[:] = list(_log_listener.handlers)
+
+def log_traceback() -> None:
+    """Log the active exception's traceback at DEBUG level, formatting it only when enabled."""
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(traceback.format_exc())
+
 @dataclass
 class Problem:
     title: str
@@ -119,17 +262,12 @@ def read_problems(file_path: str) -> List[Problem]:
         
         # Determine file type and read content
         file_extension = file_path.suffix.lower()
-        
-        if file_extension == '.docx':
-            content = read_docx_content(file_path)
-        elif file_extension in ['.md', '.markdown']:
-            content = read_markdown_content(file_path)
-        elif file_extension == '.txt':
-            content = read_text_content(file_path)
-        else:
+        reader = _READERS.get(file_extension)
+        if reader is None:
             # Try to read as plain text
             logging.warning(f"Unknown file extension {file_extension}, treating as plain text")
-            content = read_text_content(file_path)
+            reader = read_text_content
+        content = reader(file_path)
         
         # Parse problems from content
         problems = parse_problems_from_content(content)
@@ -139,34 +277,129 @@ def read_problems(file_path: str) -> List[Problem]:
         
     except Exception as e:
         logging.error(f"Failed to read problems from {file_path}: {str(e)}")
-        logging.error(traceback.format_exc())
+        log_traceback()
         return []
 
+def is_multi_file_input(input_path: str) -> bool:
+    """Whether ``--input`` names a directory or a glob pattern rather than one file."""
+    if os.path.isdir(input_path):
+        return True
+    return not os.path.exists(input_path) and any(ch in input_path for ch in '*?[')
+
+def list_problem_files(input_path: str) -> List[Path]:
+    """Return the supported input files in a directory or matching a glob pattern, sorted by name."""
+    if os.path.isdir(input_path):
+        candidates = Path(input_path).iterdir()
+    else:
+        candidates = map(Path, glob.iglob(input_path, recursive=True))
+    return sorted(
+        path for path in candidates
+        if path.is_file() and path.suffix.lower() in _READERS
+    )
+
+def _docx_style_names(archive: zipfile.ZipFile) -> Tuple[Dict[str, str], str]:
+    """Map paragraph style IDs to display names and return the default paragraph style name."""
+    names = {}
+    default_name = 'Normal'
+    try:
+        styles_xml = archive.read('word/styles.xml')
+    except KeyError:
+        return names, default_name
+    
+    for style in ElementTree.fromstring(styles_xml).iter(_W + 'style'):
+        name_elem = style.find(_W + 'name')
+        name = name_elem.get(_W + 'val', '') if name_elem is not None else ''
+        # Built-in heading styles are stored lowercase ("heading 1")
+        if name.startswith('heading '):
+            name = 'H' + name[1:]
+        names[style.get(_W + 'styleId')] = name
+        if style.get(_W + 'type') == 'paragraph' and style.get(_W + 'default') in ('1', 'true'):
+            default_name = name
+    return names, default_name
+
+def _docx_run_text(run) -> str:
+    """Text of a ``w:r`` run, with tabs and line breaks as characters."""
+    parts = []
+    for child in run:
+        tag = child.tag
+        if tag == _W + 't':
+            parts.append(child.text or '')
+        elif tag in (_W + 'tab', _W + 'ptab'):
+            parts.append('\t')
+        elif tag == _W + 'cr' or (tag == _W + 'br' and child.get(_W + 'type', 'textWrapping') == 'textWrapping'):
+            parts.append('\n')
+        elif tag == _W + 'noBreakHyphen':
+            parts.append('-')
+    return ''.join(parts)
+
+# Inline wrappers whose runs are part of the paragraph text: tracked insertions, content
+# controls, smart tags, custom XML and simple fields. Deletions (w:del, w:moveFrom) are not.
+_DOCX_RUN_CONTAINERS = frozenset(_W + tag for tag in (
+    'hyperlink', 'ins', 'moveTo', 'smartTag', 'customXml', 'sdt', 'sdtContent', 'fldSimple',
+))
+# Block-level wrappers whose paragraphs still belong to the body text
+_DOCX_BLOCK_CONTAINERS = frozenset(_W + tag for tag in ('sdt', 'sdtContent', 'customXml'))
+
+def _docx_paragraph_text(elem) -> str:
+    """Text of a ``w:p`` paragraph, including runs nested in inline wrappers."""
+    parts = []
+    for child in elem:
+        if child.tag == _W + 'r':
+            parts.append(_docx_run_text(child))
+        elif child.tag in _DOCX_RUN_CONTAINERS:
+            parts.append(_docx_paragraph_text(child))
+    return ''.join(parts)
+
 def read_docx_content(file_path: Path) -> str:
-    """Read content from a Word document (.docx)."""
+    """Read content from a Word document (.docx).
+    
+    ``word/document.xml`` is streamed with ``iterparse`` and each top-level paragraph is
+    discarded once read, so the whole document tree is never held in memory.
+    """
     try:
-        # Try to import python-docx
-        try:
-            from docx import Document
-        except ImportError:
-            logging.error("python-docx not installed. Install with: pip install python-docx")
-            raise ImportError("python-docx package required for .docx files")
-        
-        doc = Document(file_path)
         content_parts = []
+        append = content_parts.append
         
-        for paragraph in doc.paragraphs:
-            text = paragraph.text.strip()
-            if text:
-                # Preserve heading styles
-                if paragraph.style.name.startswith('Heading'):
-                    level = paragraph.style.name.replace('Heading ', '')
-                    if level.isdigit():
-                        content_parts.append('#' * int(level) + ' ' + text)
-                    else:
-                        content_parts.append('## ' + text)
-                else:
-                    content_parts.append(text)
+        with zipfile.ZipFile(file_path) as archive:
+            style_names, default_style = _docx_style_names(archive)
+            
+            with archive.open('word/document.xml') as document_xml:
+                body = None
+                # Tags of the open elements, from w:document down
+                path = []
+                for event, elem in ElementTree.iterparse(document_xml, events=('start', 'end')):
+                    if event == 'start':
+                        path.append(elem.tag)
+                        if elem.tag == _W + 'body':
+                            body = elem
+                        continue
+                    path.pop()
+                    if body is None:
+                        continue
+                    
+                    # Only paragraphs in the body flow (w:body/w:p, also inside block-level
+                    # content controls), not tables or text boxes
+                    if elem.tag == _W + 'p' and all(tag in _DOCX_BLOCK_CONTAINERS for tag in path[2:]):
+                        text = _docx_paragraph_text(elem).strip()
+                        
+                        if text:
+                            style_elem = elem.find(_W + 'pPr/' + _W + 'pStyle')
+                            style_id = style_elem.get(_W + 'val') if style_elem is not None else None
+                            style_name = style_names.get(style_id, default_style)
+                            
+                            # Preserve heading styles ("Heading N" becomes N '#' characters)
+                            if style_name.startswith('Heading'):
+                                level = style_name[8:] if style_name[:8] == 'Heading ' else ''
+                                if level.isdigit():
+                                    append('#' * int(level) + ' ' + text)
+                                else:
+                                    append('## ' + text)
+                            else:
+                                append(text)
+                    
+                    # Drop finished top-level elements
+                    if len(path) == 2:
+                        body.clear()
         
         return '\n\n'.join(content_parts)
         
@@ -183,6 +416,23 @@ def read_markdown_content(file_path: Path) -> str:
         logging.error(f"Failed to read markdown file: {str(e)}")
         raise
 
+def _structure_text_line(line: str) -> str:
+    """Convert one plain-text line to markdown, turning numbered items and titles into headings."""
+    line = line.strip()
+    if not line:
+        return ''
+    
+    # Convert numbered items to headings
+    numbered_match = _NUMBERED_LINE_RE.match(line)
+    if numbered_match:
+        return '## ' + line[numbered_match.end():]
+    
+    # Convert lines that look like titles to headings
+    if len(line) < 100 and not line.endswith(('.', ':')):
+        return '## ' + line
+    
+    return line
+
 def read_text_content(file_path: Path) -> str:
     """Read content from a plain text file."""
     try:
@@ -190,31 +440,20 @@ def read_text_content(file_path: Path) -> str:
             content = f.read()
         
         # Try to detect if it's structured content
-        lines = content.split('\n')
-        structured_content = []
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                structured_content.append('')
-                continue
-            
-            # Convert numbered items to headings
-            if re.match(r'^\d+\.\s+', line):
-                problem_text = re.sub(r'^\d+\.\s+', '', line)
-                structured_content.append(f'## {problem_text}')
-            # Convert lines that look like titles to headings
-            elif len(line) < 100 and not line.endswith('.') and not line.endswith(':'):
-                structured_content.append(f'## {line}')
-            else:
-                structured_content.append(line)
-        
-        return '\n'.join(structured_content)
+        return '\n'.join([_structure_text_line(line) for line in content.split('\n')])
         
     except Exception as e:
         logging.error(f"Failed to read text file: {str(e)}")
         raise
 
+# Content readers by (lowercase) file extension
+_READERS = {
+    '.docx': read_docx_content,
+    '.md': read_markdown_content,
+    '.markdown': read_markdown_content,
+    '.txt': read_text_content,
+}
+
 def parse_problems_from_content(content: str) -> List[Problem]:
     """Parse problems from content using multiple detection methods."""
     try:
@@ -251,71 +490,47 @@ def parse_problems_from_content(content: str) -> List[Problem]:
 
 def parse_markdown_problems(content: str) -> List[Problem]:
     """Parse problems using markdown heading structure."""
-    problems = []
-    lines = content.splitlines()
-    current_problem = None
-    current_content = []
-    
-    for line in lines:
-        # Check for heading (## or #)
-        heading_match = re.match(r'^(#{1,6})\s+(.+)', line)
-        if heading_match:
-            # Save previous problem if exists
-            if current_problem:
-                problems.append(Problem(
-                    title=current_problem,
-                    content='\n'.join(current_content).strip(),
-                    index=len(problems) + 1
-                ))
-            
-            # Start new problem
-            current_problem = heading_match.group(2).strip()
-            current_content = []
-        else:
-            if current_problem:
-                current_content.append(line)
+    # Locate every heading in one pass; each problem body is the text up to the next heading
+    matches = list(_HEADING_RE.finditer(content))
     
-    # Add last problem
-    if current_problem:
+    problems = []
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(content)
         problems.append(Problem(
-            title=current_problem,
-            content='\n'.join(current_content).strip(),
-            index=len(problems) + 1
+            title=match.group(2).strip(),
+            content=content[match.end():end].strip(),
+            index=i + 1
         ))
     
     return problems
 
 def parse_fenced_problems(content: str) -> List[Problem]:
     """Parse problems using fenced code blocks."""
+    # Only fence lines are visited; each problem body is sliced between its fences
     problems = []
-    lines = content.splitlines()
-    in_fence = False
-    current_content = []
+    body_start = None
     fence_type = None
     
-    for line in lines:
-        if re.match(r'^```(problem|math|question)', line, re.IGNORECASE):
-            in_fence = True
-            fence_type = re.match(r'^```(\w+)', line).group(1)
-            current_content = []
-        elif line.strip() == '```' and in_fence:
-            in_fence = False
-            if current_content:
-                content_text = '\n'.join(current_content).strip()
+    for match in _FENCE_LINE_RE.finditer(content):
+        if match.group('open'):
+            fence_type = match.group('open')[3:]
+            line_end = content.find('\n', match.end())
+            body_start = line_end + 1 if line_end != -1 else len(content)
+        elif body_start is not None:
+            # Skip fences that close on the line right after they open
+            if match.start() > body_start:
                 problems.append(Problem(
                     title=f'{fence_type.title()} {len(problems) + 1}',
-                    content=content_text,
+                    content=content[body_start:match.start()].strip(),
                     index=len(problems) + 1
                 ))
-            current_content = []
-        elif in_fence:
-            current_content.append(line)
+            body_start = None
     
     return problems
 
 def parse_paragraph_problems(content: str) -> List[Problem]:
     """Parse problems by splitting on double newlines."""
-    paragraphs = [p.strip() for p in content.split('\n\n') if p.strip()]
+    paragraphs = [p for p in map(str.strip, content.split('\n\n')) if p]
     
     if len(paragraphs) <= 1:
         return []
@@ -323,8 +538,7 @@ def parse_paragraph_problems(content: str) -> List[Problem]:
     problems = []
     for i, paragraph in enumerate(paragraphs):
         # Use first line or first few words as title
-        lines = paragraph.split('\n')
-        first_line = lines[0].strip()
+        first_line = paragraph.partition('\n')[0].strip()
         
         if len(first_line) > 100:
             title = f"Problem {i + 1}"
@@ -339,8 +553,17 @@ def parse_paragraph_problems(content: str) -> List[Problem]:
     
     return problems
 
-def build_model_and_tokenizer(model_name: str, device: str = "auto") -> Tuple[Any, Any]:
-    """Build and return model and tokenizer with enhanced error handling."""
+def build_model_and_tokenizer(model_name: str, device: str = "auto",
+                              torch_compile: bool = False, quant: str = "none",
+                              attn: str = "auto") -> Tuple[Any, Any]:
+    """Build and return model and tokenizer with enhanced error handling.
+    
+    With ``torch_compile`` the forward pass is compiled against a static KV cache so
+    each decode step replays as a single CUDA graph. ``quant="int4"`` loads NF4 weights
+    and ``quant="int8"`` LLM.int8() weights through bitsandbytes; ``quant="awq"`` expects
+    ``model_name`` to be a pre-quantized AWQ checkpoint (all CUDA only). ``attn`` picks
+    the attention implementation; ``"auto"`` uses FlashAttention-2 when available.
+    """
     try:
         logging.info(f"Loading model: {model_name}")
         
@@ -353,85 +576,402 @@ def build_model_and_tokenizer(model_name: str, device: str = "auto") -> Tuple[An
                 device = "cpu"
                 logging.info("Using CPU device")
         
-        # Load tokenizer
-        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # Load tokenizer (the Rust-backed fast tokenizer batches encoding natively)
+        tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        if not tokenizer.is_fast:
+            logging.warning(f"No fast tokenizer available for {model_name}, using the slower Python tokenizer")
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
+        # Decoder-only models must be left-padded for batched generation
+        tokenizer.padding_side = "left"
+        
+        # Prefer FlashAttention-2 when flash-attn is installed, otherwise PyTorch SDPA
+        flash_available = device == "cuda" and importlib.util.find_spec("flash_attn") is not None
+        if attn == "auto":
+            attn_implementation = "flash_attention_2" if flash_available else "sdpa"
+        elif attn == "flash_attention_2" and not flash_available:
+            logging.warning("FlashAttention-2 needs CUDA and the flash-attn package, falling back to sdpa")
+            attn_implementation = "sdpa"
+        else:
+            attn_implementation = attn
+        logging.info(f"Using attention implementation: {attn_implementation}")
+        
+        # Optional weight quantization
+        quantization_config = None
+        # bfloat16 needs Ampere or newer; older GPUs fall back to float16
+        if device == "cuda":
+            dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        else:
+            dtype = torch.float32
+        if quant != "none" and device != "cuda":
+            logging.warning(f"{quant} quantization requires CUDA, loading unquantized weights")
+        elif quant == "int4":
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=dtype,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_use_double_quant=True,
+            )
+            logging.info("Loading weights in 4-bit NF4")
+        elif quant == "int8":
+            quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+            logging.info("Loading weights in 8-bit LLM.int8()")
+        elif quant == "awq":
+            # AWQ checkpoints carry their own quantization config; the GEMM kernels run in fp16
+            dtype = torch.float16
+            logging.info("Loading pre-quantized AWQ weights")
+        
+        # Shard weights across all visible GPUs when more than one is available
+        if device == "cuda" and torch.cuda.device_count() > 1:
+            device_map = "auto"
+            logging.info(f"Sharding model across {torch.cuda.device_count()} GPUs")
+        else:
+            device_map = device if device != "cpu" else None
         
         # Load model
         model = AutoModelForCausalLM.from_pretrained(
             model_name,
-            torch_dtype=torch.float16 if device == "cuda" else torch.float32,
-            device_map=device if device != "cpu" else None,
-            trust_remote_code=True
+            dtype=dtype,
+            attn_implementation=attn_implementation,
+            quantization_config=quantization_config,
+            device_map=device_map,
+            trust_remote_code=False,
+            use_safetensors=True
         )
         
-        if device == "cpu":
+        # device_map already placed the weights; only CPU loads need moving
+        if device_map is None:
             model = model.to(device)
         
         model.eval()
+        
+        # reduce-overhead mode captures CUDA graphs, which only pay off on GPU
+        if torch_compile and device != "cuda":
+            logging.warning("--torch-compile requires CUDA, running the model uncompiled")
+            torch_compile = False
+        
+        if torch_compile:
+            logging.info("Compiling model forward with torch.compile and a static KV cache")
+            model.generation_config.cache_implementation = "static"
+            model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=True)
+            
+            # Warm-up generation triggers compilation before the first real batch
+            warmup_inputs = tokenizer(["Warm up"], return_tensors="pt").to(model.device)
+            with torch.no_grad():
+                model.generate(
+                    **warmup_inputs,
+                    max_new_tokens=4,
+                    do_sample=False,
+                    pad_token_id=tokenizer.pad_token_id,
+                )
+        
         logging.info(f"Model loaded successfully on {device}")
         
         return model, tokenizer
     
     except Exception as e:
         logging.error(f"Failed to load model {model_name}: {str(e)}")
-        logging.error(traceback.format_exc())
+        log_traceback()
         raise
 
-def chat_completion(model, tokenizer, messages: List[Dict[str, str]],
-                    max_new_tokens: int = 512, temperature: float = 0.2, top_p: float = 0.9) -> str:
-    """Generate chat completion using Qwen2.5-Math-7B-Instruct format."""
+def build_draft_model(draft_model_name: str, model) -> Any:
+    """Load a small same-family draft model for speculative (assisted) decoding.
+    
+    The draft model must share the main model's tokenizer (e.g. Qwen2.5-Math-1.5B
+    drafting for Qwen2.5-Math-7B).
+    """
     try:
-        # Use Qwen's chat template for proper formatting
-        text = tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
+        logging.info(f"Loading draft model for speculative decoding: {draft_model_name}")
+        draft_model = AutoModelForCausalLM.from_pretrained(
+            draft_model_name,
+            dtype=model.dtype,
+            device_map=model.device,
+            use_safetensors=True,
         )
+        draft_model.eval()
+        return draft_model
+    
+    except Exception as e:
+        logging.error(f"Failed to load draft model {draft_model_name}: {str(e)}")
+        log_traceback()
+        raise
+
+def build_llm_engine(model_name: str, engine: str, quant: str = "none",
+                     max_model_len: Optional[int] = None) -> Tuple[Any, Any]:
+    """Build a vLLM or TensorRT-LLM engine plus the HF tokenizer used for chat templates.
+    
+    ``quant="fp8"`` builds FP8 weights/KV cache (Hopper+); ``quant="int4"`` uses
+    bitsandbytes (vLLM) or INT4 AWQ (TensorRT-LLM); ``quant="int8"`` builds INT8
+    weight-only TensorRT-LLM engines; ``quant="awq"`` serves a pre-quantized AWQ checkpoint.
+    ``max_model_len`` caps the vLLM context so the paged KV cache fits more sequences.
+    """
+    try:
+        logging.info(f"Loading model {model_name} with {engine} engine")
         
-        # Tokenize the formatted text
-        model_inputs = tokenizer([text], return_tensors="pt").to(model.device)
+        # Tensor-parallel across all visible GPUs
+        tensor_parallel_size = max(1, torch.cuda.device_count())
+        
+        if engine == "vllm":
+            try:
+                from vllm import LLM
+            except ImportError:
+                logging.error("vllm not installed. Install with: pip install vllm")
+                raise ImportError("vllm package required for --engine vllm")
+            quantization = {"fp8": "fp8", "int4": "bitsandbytes", "awq": "awq"}.get(quant)
+            if quant == "int8":
+                logging.warning("vLLM has no int8 weight quantization for this model, loading unquantized weights")
+            llm = LLM(
+                model=model_name,
+                dtype="float16" if quant == "awq" else "bfloat16",
+                gpu_memory_utilization=0.95,
+                max_model_len=max_model_len,
+                quantization=quantization,
+                tensor_parallel_size=tensor_parallel_size,
+            )
+        elif engine == "trtllm":
+            try:
+                from tensorrt_llm import LLM
+                from tensorrt_llm.llmapi import KvCacheConfig
+            except ImportError:
+                logging.error("tensorrt_llm not installed. Install with: pip install tensorrt_llm")
+                raise ImportError("tensorrt_llm package required for --engine trtllm")
+            llm_kwargs = {}
+            if quant != "none":
+                from tensorrt_llm.llmapi import QuantConfig, QuantAlgo
+                if quant == "fp8":
+                    llm_kwargs["quant_config"] = QuantConfig(quant_algo=QuantAlgo.FP8, kv_cache_quant_algo=QuantAlgo.FP8)
+                elif quant == "int8":
+                    llm_kwargs["quant_config"] = QuantConfig(quant_algo=QuantAlgo.W8A16)
+                else:
+                    llm_kwargs["quant_config"] = QuantConfig(quant_algo=QuantAlgo.W4A16_AWQ)
+            llm = LLM(
+                model=model_name,
+                kv_cache_config=KvCacheConfig(free_gpu_memory_fraction=0.95),
+                tensor_parallel_size=tensor_parallel_size,
+                **llm_kwargs,
+            )
+        else:
+            raise ValueError(f"Unsupported engine: {engine}")
+        
+        tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        
+        logging.info(f"{engine} engine loaded successfully")
+        return llm, tokenizer
+    
+    except Exception as e:
+        logging.error(f"Failed to load model {model_name} with {engine} engine: {str(e)}")
+        log_traceback()
+        raise
+
+def engine_completion(llm, tokenizer, messages_batch: List[List[Dict[str, str]]],
+                      max_new_tokens: int = 512, temperature: float = 0.2, top_p: float = 0.9,
+                      greedy: bool = False, engine: str = "vllm") -> List[str]:
+    """Generate chat completions for all conversations with one vLLM/TensorRT-LLM call."""
+    try:
+        if engine == "trtllm":
+            from tensorrt_llm import SamplingParams
+        else:
+            from vllm import SamplingParams
+        
+        if greedy:
+            sampling_params = SamplingParams(temperature=0.0, top_p=1.0, max_tokens=max_new_tokens)
+        else:
+            sampling_params = SamplingParams(temperature=temperature, top_p=top_p, max_tokens=max_new_tokens)
+        
+        # The engine schedules all prompts itself (in-flight batching, paged KV cache)
+        if engine == "vllm":
+            # vLLM applies the model's chat template itself
+            outputs = llm.chat(messages_batch, sampling_params, use_tqdm=False)
+        else:
+            prompts = [
+                tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+                for messages in messages_batch
+            ]
+            outputs = llm.generate(prompts, sampling_params)
+        
+        results = []
+        for i, output in enumerate(outputs):
+            response = output.outputs[0].text
+            logging.debug(f"Response [{i}]: '{response}'")
+            if not response.strip():
+                logging.warning(f"Empty response generated by the model for batch item {i}")
+                results.append("No response generated")
+            else:
+                results.append(response.strip())
+        
+        return results
+    
+    except Exception as e:
+        logging.error(f"Error in {engine} completion: {str(e)}")
+        log_traceback()
+        return [f"Error generating response: {str(e)}"] * len(messages_batch)
+
+def _sampling_kwargs(temperature: float, top_p: float, greedy: bool) -> Dict[str, Any]:
+    """Return generate() decoding arguments; greedy skips the sampling softmax/top-p work."""
+    if greedy:
+        return {"do_sample": False, "num_beams": 1}
+    return {"do_sample": True, "temperature": temperature, "top_p": top_p}
+
+@functools.lru_cache(maxsize=16)
+def _encode_system_prompt(tokenizer, system_prompt: str) -> Tuple[str, Tuple[int, ...]]:
+    """Render and tokenize a system turn once per tokenizer and system prompt."""
+    system_text = tokenizer.apply_chat_template(
+        [{"role": "system", "content": system_prompt}],
+        tokenize=False
+    )
+    return system_text, tuple(tokenizer(system_text).input_ids)
+
+def encode_chat(tokenizer, messages: List[Dict[str, str]]) -> List[int]:
+    """Tokenize a chat prompt, reusing the cached token IDs of its system turn.
+    
+    The system prompt only depends on the grade level, so across a run only the user
+    turn and generation prompt are tokenized per problem.
+    """
+    text = tokenizer.apply_chat_template(
+        messages,
+        tokenize=False,
+        add_generation_prompt=True
+    )
+    if messages and messages[0]["role"] == "system":
+        system_text, system_ids = _encode_system_prompt(tokenizer, messages[0]["content"])
+        if text.startswith(system_text):
+            suffix_ids = tokenizer(text[len(system_text):], add_special_tokens=False).input_ids
+            return list(system_ids) + suffix_ids
+    return tokenizer(text).input_ids
+
+@functools.lru_cache(maxsize=4)
+def _system_prompt_cache(model, system_ids: Tuple[int, ...]) -> Any:
+    """Prefill the KV cache of a system turn once per model; callers must deep-copy it."""
+    cache = DynamicCache()
+    with torch.no_grad():
+        model(input_ids=torch.tensor([system_ids], device=model.device), past_key_values=cache, use_cache=True)
+    return cache
+
+def _shared_prefix_cache(model, tokenizer, messages: List[Dict[str, str]], input_ids: List[int]) -> Optional[Any]:
+    """Return a private copy of the prefilled system-turn KV cache if ``input_ids`` starts with it."""
+    if not messages or messages[0]["role"] != "system":
+        return None
+    # A compiled static cache cannot take a prefilled dynamic cache
+    if getattr(model.generation_config, "cache_implementation", None) == "static":
+        return None
+    _, system_ids = _encode_system_prompt(tokenizer, messages[0]["content"])
+    if len(input_ids) <= len(system_ids) or tuple(input_ids[:len(system_ids)]) != system_ids:
+        return None
+    return copy.deepcopy(_system_prompt_cache(model, system_ids))
+
+def chat_completion(model, tokenizer, messages_batch: List[List[Dict[str, str]]],
+                    max_new_tokens: int = 512, temperature: float = 0.2, top_p: float = 0.9,
+                    greedy: bool = False,
+                    assistant_model: Optional[Any] = None) -> List[str]:
+    """Generate chat completions for a batch of conversations with a single generate call.
+    
+    ``assistant_model`` enables speculative decoding, which transformers only supports
+    for a single conversation per call. A single conversation without a draft model reuses the prefilled KV cache of its system turn; batched rows
+    are left-padded, so their system turns sit at different positions and cannot share it.
+    """
+    try:
+        # Use Qwen's chat template for proper formatting
+        input_ids = [encode_chat(tokenizer, messages) for messages in messages_batch]
+        
+        # Pad the batch (left-padded, see build_model_and_tokenizer)
+        model_inputs = tokenizer.pad({"input_ids": input_ids}, padding=True, return_tensors="pt").to(model.device)
+        
+        generate_kwargs = dict(
+            input_ids=model_inputs.input_ids,
+            attention_mask=model_inputs.attention_mask,
+            max_new_tokens=max_new_tokens,
+            **_sampling_kwargs(temperature, top_p, greedy),
+            pad_token_id=tokenizer.pad_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+        )
+        if assistant_model is not None:
+            generate_kwargs["assistant_model"] = assistant_model
+        elif len(input_ids) == 1:
+            prefix_cache = _shared_prefix_cache(model, tokenizer, messages_batch[0], input_ids[0])
+            if prefix_cache is not None:
+                generate_kwargs["past_key_values"] = prefix_cache
         
         # Generate
         with torch.no_grad():
-            generated_ids = model.generate(
-                **model_inputs,
-                max_new_tokens=max_new_tokens,
-                temperature=temperature,
-                top_p=top_p,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id,
-                eos_token_id=tokenizer.eos_token_id,
-            )
+            generated_ids = model.generate(**generate_kwargs)
         
-        # Extract only the generated tokens (excluding input)
+        # Extract only the generated tokens (excluding input); with left padding every
+        # row's prompt ends at the padded input length
         generated_ids = [
             output_ids[len(input_ids):] for input_ids, output_ids in zip(model_inputs.input_ids, generated_ids)
         ]
         
-        # Decode response using batch_decode as recommended by Qwen
-        response = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)[0]
+        # Decode responses using batch_decode as recommended by Qwen
+        responses = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
         
         # Debug information
-        logging.debug(f"Input length: {model_inputs.input_ids.shape[1]}")
-        logging.debug(f"Generated tokens length: {len(generated_ids[0])}")
-        logging.debug(f"Generated token IDs: {generated_ids[0].tolist()}")
-        logging.debug(f"Response: '{response}'")
-        
-        if not response.strip():
-            logging.warning("Empty response generated by the model")
-            return "No response generated"
+        logging.debug(f"Batch size: {len(input_ids)}, padded input length: {model_inputs.input_ids.shape[1]}")
+        
+        results = []
+        for i, response in enumerate(responses):
+            logging.debug(f"Generated tokens length [{i}]: {len(generated_ids[i])}")
+            logging.debug(f"Response [{i}]: '{response}'")
+            if not response.strip():
+                logging.warning(f"Empty response generated by the model for batch item {i}")
+                results.append("No response generated")
+            else:
+                results.append(response.strip())
         
-        return response.strip()
+        return results
     
     except Exception as e:
         logging.error(f"Error in chat completion: {str(e)}")
-        logging.error(traceback.format_exc())
-        return f"Error generating response: {str(e)}"
+        log_traceback()
+        return [f"Error generating response: {str(e)}"] * len(messages_batch)
 
-def explanation_prompt(problem_text: str, grade_level: str = "middle school") -> List[Dict[str, str]]:
-    """Create enhanced prompt for generating comprehensive explanations tailored to grade level."""
+def continuous_batch_completion(model, tokenizer, messages_batch: List[List[Dict[str, str]]],
+                                max_new_tokens: int = 512, temperature: float = 0.2, top_p: float = 0.9,
+                                greedy: bool = False) -> List[str]:
+    """Generate chat completions with transformers' continuous batching scheduler.
+    
+    All prompts are submitted upfront; finished sequences free their slot immediately
+    so short responses do not wait for the longest one in the batch.
+    """
+    if not hasattr(model, "generate_batch"):
+        logging.warning("Installed transformers has no continuous batching support, using padded batching")
+        return chat_completion(model, tokenizer, messages_batch, max_new_tokens, temperature, top_p, greedy)
+    
+    try:
+        inputs = [encode_chat(tokenizer, messages) for messages in messages_batch]
+        generation_config = GenerationConfig(
+            max_new_tokens=max_new_tokens,
+            **_sampling_kwargs(temperature, top_p, greedy),
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+        
+        with torch.no_grad():
+            outputs = model.generate_batch(inputs=inputs, generation_config=generation_config)
+        
+        # Results come back keyed by request id ("..._<index>") in completion order
+        results = ["No response generated"] * len(inputs)
+        for request_id, output in outputs.items():
+            index = int(request_id.rsplit('_', 1)[-1])
+            response = tokenizer.decode(output.generated_tokens, skip_special_tokens=True)
+            logging.debug(f"Response [{request_id}]: '{response}'")
+            if response.strip():
+                results[index] = response.strip()
+            else:
+                logging.warning(f"Empty response generated by the model for request {request_id}")
+        
+        return results
+    
+    except Exception as e:
+        logging.error(f"Error in continuous batch completion: {str(e)}")
+        log_traceback()
+        return [f"Error generating response: {str(e)}"] * len(messages_batch)
+
+@functools.lru_cache(maxsize=8)
+def _explanation_prompt_parts(grade_level: str) -> Tuple[Dict[str, str], str, str]:
+    """Build the system message and the user prompt around the problem text once per grade level.
+    
+    The system message dict is shared by every prompt for the grade level and must not be mutated.
+    """
     
     # Define grade-specific language and complexity
     grade_configs = {
@@ -466,10 +1006,12 @@ def explanation_prompt(problem_text: str, grade_level: str = "middle school") ->
 
 Your role is to analyze mathematical problems and create comprehensive educational materials that help {grade_level} students understand both the solution process and underlying concepts using {config['language']}."""
 
-    user_prompt = f"""Please analyze this mathematical problem and provide a comprehensive educational response in markdown format, specifically tailored for {grade_level} students:
+    user_prefix = f"""Please analyze this mathematical problem and provide a comprehensive educational response in markdown format, specifically tailored for {grade_level} students:
 
 **Problem:**
-{problem_text}
+"""
+
+    user_suffix = f"""
 
 **Required Markdown Structure:**
 
@@ -501,38 +1043,25 @@ The final numerical or algebraic answer, clearly stated
 
 Please respond using the exact markdown structure above, ensuring all content is appropriate for {grade_level} students."""
 
+    return {"role": "system", "content": system_prompt}, user_prefix, user_suffix
+
+def explanation_prompt(problem_text: str, grade_level: str = "middle school") -> List[Dict[str, str]]:
+    """Create enhanced prompt for generating comprehensive explanations tailored to grade level."""
+    system_message, user_prefix, user_suffix = _explanation_prompt_parts(grade_level)
     return [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_prompt}
+        system_message,
+        {"role": "user", "content": ''.join((user_prefix, problem_text, user_suffix))}
     ]
 
-def create_tape_diagram(problem_text: str, solution: str = "") -> str:
-    """
-    Create Singapore Math tape/bar diagram visualization using CSS and HTML.
-    Analyzes the problem to identify quantities and relationships for visual representation.
-    """
-    
-    def render_latex_math(text: str) -> str:
-        """Convert content inside [ ] brackets to LaTeX math notation."""
-        import re
-        # Replace [content] with $content$ for inline math
-        text = re.sub(r'\[([^\]]+)\]', r'$\1$', text)
+def render_latex_math(text: str) -> str:
+    """Convert content inside [ ] brackets to LaTeX math notation."""
+    # Replace [content] with $content$ for inline math
+    if '[' not in text:
         return text
-    
-    # Apply LaTeX rendering to input text
-    problem_text = render_latex_math(problem_text)
-    solution = render_latex_math(solution)
-    
-    # Extract numbers and relationships from problem text
-    import re
-    numbers = re.findall(r'\b\d+\b', problem_text)
-    
-    # Common Singapore Math problem patterns
-    tape_diagram = ""
-    
-    # Check for addition/subtraction problems
-    if any(word in problem_text.lower() for word in ['total', 'altogether', 'sum', 'more', 'less', 'difference']):
-        tape_diagram = f"""
+    return _BRACKET_MATH_RE.sub(r'$\1$', text)
+
+# Tape diagram templates, filled in by create_tape_diagram
+_TAPE_ADDITION_TEMPLATE = """
 <div class="tape-diagram">
 <h4>📊 Tape Diagram Visualization</h4>
 
@@ -540,7 +1069,7 @@ def create_tape_diagram(problem_text: str, solution: str = "") -> str:
   <div class="tape-section">
     <div class="tape-bar known" style="width: 150px;">
       <span class="tape-label">Known Quantity</span>
-      <span class="tape-value">{numbers[0] if numbers else '?'}</span>
+      <span class="tape-value">{first}</span>
     </div>
   </div>
   
@@ -554,7 +1083,7 @@ def create_tape_diagram(problem_text: str, solution: str = "") -> str:
   <div class="tape-total">
     <div class="tape-bar total" style="width: 250px;">
       <span class="tape-label">Total</span>
-      <span class="tape-value">{numbers[1] if len(numbers) > 1 else '?'}</span>
+      <span class="tape-value">{second}</span>
     </div>
   </div>
 </div>
@@ -567,10 +1096,8 @@ def create_tape_diagram(problem_text: str, solution: str = "") -> str:
 </div>
 </div>
 """
-    
-    # Check for multiplication/division problems
-    elif any(word in problem_text.lower() for word in ['times', 'groups', 'each', 'per', 'rate', 'equal']):
-        tape_diagram = f"""
+
+_TAPE_GROUPS_TEMPLATE = """
 <div class="tape-diagram">
 <h4>📊 Tape Diagram Visualization</h4>
 
@@ -578,24 +1105,24 @@ def create_tape_diagram(problem_text: str, solution: str = "") -> str:
   <div class="tape-groups">
     <div class="tape-group">
       <div class="tape-bar group" style="width: 80px;">
-        <span class="tape-value">{numbers[0] if numbers else '?'}</span>
+        <span class="tape-value">{first}</span>
       </div>
     </div>
     <div class="tape-group">
       <div class="tape-bar group" style="width: 80px;">
-        <span class="tape-value">{numbers[0] if numbers else '?'}</span>
+        <span class="tape-value">{first}</span>
       </div>
     </div>
     <div class="tape-group">
       <div class="tape-bar group" style="width: 80px;">
-        <span class="tape-value">{numbers[0] if numbers else '?'}</span>
+        <span class="tape-value">{first}</span>
       </div>
     </div>
   </div>
   
   <div class="tape-total">
     <div class="tape-bar total" style="width: 250px;">
-      <span class="tape-label">Total: {len(numbers) > 1 and numbers[1] or '?'}</span>
+      <span class="tape-label">Total: {second}</span>
     </div>
   </div>
 </div>
@@ -608,10 +1135,8 @@ def create_tape_diagram(problem_text: str, solution: str = "") -> str:
 </div>
 </div>
 """
-    
-    # Check for fraction/ratio problems
-    elif any(word in problem_text.lower() for word in ['fraction', 'part', 'ratio', 'proportion', 'percent']):
-        tape_diagram = f"""
+
+_TAPE_FRACTION_TEMPLATE = """
 <div class="tape-diagram">
 <h4>📊 Tape Diagram Visualization</h4>
 
@@ -628,7 +1153,7 @@ def create_tape_diagram(problem_text: str, solution: str = "") -> str:
   </div>
   
   <div class="tape-labels">
-    <span class="whole-label">Whole = {numbers[0] if numbers else '?'}</span>
+    <span class="whole-label">Whole = {first}</span>
   </div>
 </div>
 
@@ -640,10 +1165,8 @@ def create_tape_diagram(problem_text: str, solution: str = "") -> str:
 </div>
 </div>
 """
-    
-    # Default generic tape diagram
-    else:
-        tape_diagram = f"""
+
+_TAPE_GENERIC_TEMPLATE = """
 <div class="tape-diagram">
 <h4>📊 Tape Diagram Visualization</h4>
 
@@ -651,7 +1174,7 @@ def create_tape_diagram(problem_text: str, solution: str = "") -> str:
   <div class="tape-section">
     <div class="tape-bar generic" style="width: 200px;">
       <span class="tape-label">Given Information</span>
-      <span class="tape-value">{', '.join(numbers[:2]) if numbers else 'Given values'}</span>
+      <span class="tape-value">{given}</span>
     </div>
   </div>
   
@@ -671,58 +1194,64 @@ def create_tape_diagram(problem_text: str, solution: str = "") -> str:
 </div>
 </div>
 """
-    
-    return tape_diagram
-
 
-def create_step_diagram(step_text: str, step_number: int, problem_context: str = "") -> str:
+@functools.lru_cache(maxsize=512)
+def create_tape_diagram(problem_text: str, solution: str = "") -> str:
     """
-    Create a step-specific tape diagram for each solution step.
-    Analyzes the step to create relevant visual representation.
+    Create Singapore Math tape/bar diagram visualization using CSS and HTML.
+    Analyzes the problem to identify quantities and relationships for visual representation.
     """
-    import re
-    
-    def render_latex_math(text: str) -> str:
-        """Convert content inside [ ] brackets to LaTeX math notation."""
-        # Replace [content] with $content$ for inline math
-        text = re.sub(r'\[([^\]]+)\]', r'$\1$', text)
-        return text
     
     # Apply LaTeX rendering to input text
-    step_text = render_latex_math(step_text)
-    problem_context = render_latex_math(problem_context)
+    problem_text = render_latex_math(problem_text)
+    solution = render_latex_math(solution)
     
-    # Extract numbers from the current step
-    numbers = re.findall(r'\b\d+(?:\.\d+)?\b', step_text)
+    # Extract numbers and relationships from problem text
+    numbers = _INT_RE.findall(problem_text)
+    first = numbers[0] if numbers else '?'
+    second = numbers[1] if len(numbers) > 1 else '?'
+    problem_lower = problem_text.lower()
     
-    # Clean and analyze step text
-    step_lower = step_text.lower().strip()
+    # Common Singapore Math problem patterns
+    # Check for addition/subtraction problems
+    if any(word in problem_lower for word in ['total', 'altogether', 'sum', 'more', 'less', 'difference']):
+        tape_diagram = _TAPE_ADDITION_TEMPLATE.format(first=first, second=second)
     
-    # Determine diagram type based on step content
-    diagram_html = f"""
+    # Check for multiplication/division problems
+    elif any(word in problem_lower for word in ['times', 'groups', 'each', 'per', 'rate', 'equal']):
+        tape_diagram = _TAPE_GROUPS_TEMPLATE.format(first=first, second=second)
+    
+    # Check for fraction/ratio problems
+    elif any(word in problem_lower for word in ['fraction', 'part', 'ratio', 'proportion', 'percent']):
+        tape_diagram = _TAPE_FRACTION_TEMPLATE.format(first=first)
+    
+    # Default generic tape diagram
+    else:
+        tape_diagram = _TAPE_GENERIC_TEMPLATE.format(
+            given=', '.join(numbers[:2]) if numbers else 'Given values'
+        )
+    
+    return tape_diagram
+
+
+# Step diagram templates, filled in by the _render_*_step functions
+_STEP_HEADER_TEMPLATE = """
 <div class="step-diagram" id="step-{step_number}">
 <h5>📊 Step {step_number} Visualization</h5>
 
 <div class="tape-container">
 """
-    
-    # Check for arithmetic operations in the step
-    if any(op in step_lower for op in ['add', 'plus', '+', 'sum', 'total', 'combine']):
-        # Addition diagram
-        num1 = numbers[0] if len(numbers) >= 1 else "a"
-        num2 = numbers[1] if len(numbers) >= 2 else "b"
-        result = numbers[2] if len(numbers) >= 3 else str(int(num1) + int(num2)) if num1.isdigit() and num2.isdigit() else "?"
-        
-        diagram_html += f"""
+
+_STEP_ADDITION_TEMPLATE = """
   <div class="operation-visual addition">
     <div class="tape-bar operand known" style="width: 120px;">
       <span class="tape-label">First Number</span>
-      <span class="tape-value">{num1}</span>
+      <span class="tape-value">{first}</span>
     </div>
     <span class="operation-symbol">+</span>
     <div class="tape-bar operand known" style="width: 120px;">
       <span class="tape-label">Second Number</span>
-      <span class="tape-value">{num2}</span>
+      <span class="tape-value">{second}</span>
     </div>
     <span class="equals">=</span>
     <div class="tape-bar result" style="width: 150px;">
@@ -731,23 +1260,17 @@ def create_step_diagram(step_text: str, step_number: int, problem_context: str =
     </div>
   </div>
 """
-    
-    elif any(op in step_lower for op in ['subtract', 'minus', '-', 'difference', 'less', 'remove', 'take away']):
-        # Subtraction diagram
-        num1 = numbers[0] if len(numbers) >= 1 else "x"
-        num2 = numbers[1] if len(numbers) >= 2 else "y"
-        result = numbers[2] if len(numbers) >= 3 else str(int(num1) - int(num2)) if num1.isdigit() and num2.isdigit() else "?"
-        
-        diagram_html += f"""
+
+_STEP_SUBTRACTION_TEMPLATE = """
   <div class="operation-visual subtraction">
     <div class="tape-bar minuend known" style="width: 150px;">
       <span class="tape-label">Start with</span>
-      <span class="tape-value">{num1}</span>
+      <span class="tape-value">{first}</span>
     </div>
     <span class="operation-symbol">-</span>
     <div class="tape-bar subtrahend known" style="width: 100px;">
       <span class="tape-label">Remove</span>
-      <span class="tape-value">{num2}</span>
+      <span class="tape-value">{second}</span>
     </div>
     <span class="equals">=</span>
     <div class="tape-bar result" style="width: 120px;">
@@ -756,113 +1279,52 @@ def create_step_diagram(step_text: str, step_number: int, problem_context: str =
     </div>
   </div>
 """
-    
-    elif any(op in step_lower for op in ['multiply', 'times', '×', '*', 'groups', 'each', 'per']):
-        # Multiplication diagram
-        num1 = numbers[0] if len(numbers) >= 1 else "3"
-        num2 = numbers[1] if len(numbers) >= 2 else "4"
-        result = numbers[2] if len(numbers) >= 3 else str(int(num1) * int(num2)) if num1.isdigit() and num2.isdigit() else "?"
-        
-        groups = min(int(num1) if num1.isdigit() and int(num1) <= 6 else 3, 4)
-        diagram_html += f"""
+
+_STEP_MULTIPLICATION_TEMPLATE = """
   <div class="operation-visual multiplication">
     <div class="multiplication-groups">
-"""
-        for i in range(groups):
-            diagram_html += f"""
-      <div class="tape-group">
-        <div class="tape-bar group known" style="width: 60px;">
-          <span class="tape-label">Group {i+1}</span>
-          <span class="tape-value">{num2}</span>
-        </div>
-      </div>
-"""
-        diagram_html += f"""
+{groups}
     </div>
     <div class="multiplication-result">
       <div class="tape-bar total result" style="width: 200px;">
-        <span class="tape-label">{num1} groups of {num2}</span>
+        <span class="tape-label">{first} groups of {second}</span>
         <span class="tape-value">= {result}</span>
       </div>
     </div>
   </div>
 """
-    
-    elif any(op in step_lower for op in ['divide', '÷', '/', 'split', 'share', 'equal parts']):
-        # Division diagram
-        num1 = numbers[0] if len(numbers) >= 1 else "12"
-        num2 = numbers[1] if len(numbers) >= 2 else "3"
-        result = numbers[2] if len(numbers) >= 3 else str(int(num1) // int(num2)) if num1.isdigit() and num2.isdigit() else "?"
-        
-        diagram_html += f"""
+
+_STEP_DIVISION_TEMPLATE = """
   <div class="operation-visual division">
     <div class="tape-bar dividend known" style="width: 240px;">
       <span class="tape-label">Total to divide</span>
-      <span class="tape-value">{num1}</span>
+      <span class="tape-value">{first}</span>
     </div>
     <div class="division-groups">
+{groups}
+    </div>
+  </div>
 """
-        groups = min(int(num2) if num2.isdigit() and int(num2) <= 6 else 3, 4)
-        for i in range(groups):
-            diagram_html += f"""
+
+_STEP_GROUP_TEMPLATE = """
       <div class="tape-group">
-        <div class="tape-bar group result" style="width: 50px;">
-          <span class="tape-label">Part {i+1}</span>
-          <span class="tape-value">{result}</span>
+        <div class="tape-bar group {kind}" style="width: {width}px;">
+          <span class="tape-label">{label} {index}</span>
+          <span class="tape-value">{value}</span>
         </div>
       </div>
 """
-        diagram_html += f"""
-    </div>
-  </div>
-"""
-    
-    elif any(keyword in step_lower for keyword in ['equation', 'solve', 'find', 'calculate', 'determine']):
-        # Problem-solving step diagram
-        if numbers:
-            diagram_html += f"""
-  <div class="operation-visual generic">
-    <div class="tape-bar step-info known" style="width: 250px;">
-      <span class="tape-label">Step {step_number}: Working with</span>
-      <span class="tape-value">{', '.join(numbers[:3])}</span>
-    </div>
-  </div>
-"""
-        else:
-            diagram_html += f"""
-  <div class="operation-visual generic">
-    <div class="tape-bar step-info" style="width: 200px;">
-      <span class="tape-label">Step {step_number}</span>
-      <span class="tape-value">Analyzing...</span>
-    </div>
-  </div>
-"""
-    
-    else:
-        # Enhanced generic step diagram
-        if numbers:
-            diagram_html += f"""
-  <div class="operation-visual generic">
-    <div class="tape-bar step-info known" style="width: 200px;">
-      <span class="tape-label">Step {step_number}</span>
-      <span class="tape-value">Values: {', '.join(numbers[:2])}</span>
-    </div>
-  </div>
-"""
-        else:
-            diagram_html += f"""
+
+_STEP_INFO_TEMPLATE = """
   <div class="operation-visual generic">
-    <div class="tape-bar step-info" style="width: 200px;">
-      <span class="tape-label">Step {step_number}</span>
-      <span class="tape-value">Processing...</span>
+    <div class="tape-bar {css_class}" style="width: {width}px;">
+      <span class="tape-label">{label}</span>
+      <span class="tape-value">{value}</span>
     </div>
   </div>
 """
-    
-    # Truncate step text for display
-    display_text = step_text[:150] + "..." if len(step_text) > 150 else step_text
-    
-    diagram_html += f"""
+
+_STEP_FOOTER_TEMPLATE = """
 </div>
 
 <div class="step-explanation">
@@ -871,73 +1333,312 @@ def create_step_diagram(step_text: str, step_number: int, problem_context: str =
 </div>
 
 """
-    
-    return diagram_html
 
+def _operands(numbers: List[str], first: str, second: str) -> Tuple[str, str]:
+    """Return the first two numbers of a step, or the given placeholders."""
+    return (numbers[0] if len(numbers) >= 1 else first,
+            numbers[1] if len(numbers) >= 2 else second)
+
+def _render_addition_step(numbers: List[str], step_number: int) -> str:
+    num1, num2 = _operands(numbers, "a", "b")
+    result = numbers[2] if len(numbers) >= 3 else str(int(num1) + int(num2)) if num1.isdigit() and num2.isdigit() else "?"
+    return _STEP_ADDITION_TEMPLATE.format(first=num1, second=num2, result=result)
+
+def _render_subtraction_step(numbers: List[str], step_number: int) -> str:
+    num1, num2 = _operands(numbers, "x", "y")
+    result = numbers[2] if len(numbers) >= 3 else str(int(num1) - int(num2)) if num1.isdigit() and num2.isdigit() else "?"
+    return _STEP_SUBTRACTION_TEMPLATE.format(first=num1, second=num2, result=result)
+
+def _render_multiplication_step(numbers: List[str], step_number: int) -> str:
+    num1, num2 = _operands(numbers, "3", "4")
+    result = numbers[2] if len(numbers) >= 3 else str(int(num1) * int(num2)) if num1.isdigit() and num2.isdigit() else "?"
+    groups = min(int(num1) if num1.isdigit() and int(num1) <= 6 else 3, 4)
+    group_html = "".join([
+        _STEP_GROUP_TEMPLATE.format(kind="known", width=60, label="Group", index=i + 1, value=num2)
+        for i in range(groups)
+    ])
+    return _STEP_MULTIPLICATION_TEMPLATE.format(groups=group_html, first=num1, second=num2, result=result)
+
+def _render_division_step(numbers: List[str], step_number: int) -> str:
+    num1, num2 = _operands(numbers, "12", "3")
+    result = numbers[2] if len(numbers) >= 3 else str(int(num1) // int(num2)) if num1.isdigit() and num2.isdigit() else "?"
+    groups = min(int(num2) if num2.isdigit() and int(num2) <= 6 else 3, 4)
+    group_html = "".join([
+        _STEP_GROUP_TEMPLATE.format(kind="result", width=50, label="Part", index=i + 1, value=result)
+        for i in range(groups)
+    ])
+    return _STEP_DIVISION_TEMPLATE.format(first=num1, groups=group_html)
+
+def _render_solving_step(numbers: List[str], step_number: int) -> str:
+    if numbers:
+        return _STEP_INFO_TEMPLATE.format(css_class="step-info known", width=250,
+                                          label=f"Step {step_number}: Working with",
+                                          value=', '.join(numbers[:3]))
+    return _STEP_INFO_TEMPLATE.format(css_class="step-info", width=200,
+                                      label=f"Step {step_number}", value="Analyzing...")
+
+def _render_generic_step(numbers: List[str], step_number: int) -> str:
+    if numbers:
+        return _STEP_INFO_TEMPLATE.format(css_class="step-info known", width=200,
+                                          label=f"Step {step_number}",
+                                          value=f"Values: {', '.join(numbers[:2])}")
+    return _STEP_INFO_TEMPLATE.format(css_class="step-info", width=200,
+                                      label=f"Step {step_number}", value="Processing...")
+
+# Step operations in priority order, with the keywords that select each one
+_STEP_OPERATIONS = (
+    ("addition", ('add', 'plus', '+', 'sum', 'total', 'combine')),
+    ("subtraction", ('subtract', 'minus', '-', 'difference', 'less', 'remove', 'take away')),
+    ("multiplication", ('multiply', 'times', '×', '*', 'groups', 'each', 'per')),
+    ("division", ('divide', '÷', '/', 'split', 'share', 'equal parts')),
+    ("solving", ('equation', 'solve', 'find', 'calculate', 'determine')),
+)
+
+_OP_RENDERERS = {
+    "addition": _render_addition_step,
+    "subtraction": _render_subtraction_step,
+    "multiplication": _render_multiplication_step,
+    "division": _render_division_step,
+    "solving": _render_solving_step,
+    "generic": _render_generic_step,
+}
 
-def create_solution_with_diagrams(solution_text: str, problem_text: str = "") -> str:
+@functools.lru_cache(maxsize=512)
+def create_step_diagram(step_text: str, step_number: int, problem_context: str = "") -> str:
     """
-    Process the solution text and insert step-by-step diagrams.
-    Breaks down the solution into steps and adds visual diagrams for each.
+    Create a step-specific tape diagram for each solution step.
+    Analyzes the step to create relevant visual representation.
     """
+    # Apply LaTeX rendering to input text
+    step_text = render_latex_math(step_text)
     
-    # Split solution into steps (look for numbered steps, bullet points, or line breaks)
-    import re
+    # Extract numbers from the current step
+    numbers = _NUM_RE.findall(step_text)
     
-    # Try to identify step patterns
-    step_patterns = [
-        r'(?:Step\s*\d+[:.]\s*)(.*?)(?=Step\s*\d+[:.]\s*|\Z)',  # "Step 1:", "Step 2:", etc.
-        r'(?:\d+[.)]\s*)(.*?)(?=\d+[.)]\s*|\Z)',  # "1.", "2.", etc.
-        r'(?:^\s*[-*]\s*)(.*?)(?=^\s*[-*]\s*|\Z)',  # Bullet points
-    ]
+    # Clean and analyze step text
+    step_lower = step_text.lower().strip()
+    
+    # Determine diagram type based on step content
+    op_type = next(
+        (name for name, keywords in _STEP_OPERATIONS if any(op in step_lower for op in keywords)),
+        "generic",
+    )
+    
+    # Truncate step text for display
+    display_text = step_text[:150] + "..." if len(step_text) > 150 else step_text
+    
+    return "".join([
+        _STEP_HEADER_TEMPLATE.format(step_number=step_number),
+        _OP_RENDERERS[op_type](numbers, step_number),
+        _STEP_FOOTER_TEMPLATE.format(display_text=display_text),
+    ])
+
+def _split_steps(solution_text: str) -> List[str]:
+    """
+    Split a solution into steps with a single pass over its lines.
+    
+    Lines starting with "Step N:", "N." / "N)" or a "-" / "*" bullet open a new step.
+    Marker kinds are preferred in that order and the first one found on more than one
+    line is used. Without markers the text is split into paragraphs, then sentences.
+    """
+    lines = solution_text.split('\n')
+    
+    # (line index, text after the marker) for each kind of step marker
+    markers = ([], [], [])
+    for index, line in enumerate(lines):
+        stripped = line.lstrip()
+        if stripped.startswith('Step'):
+            rest = stripped[4:].lstrip()
+            number_end = len(rest) - len(rest.lstrip('0123456789'))
+            if number_end and rest[number_end:number_end + 1] in (':', '.'):
+                markers[0].append((index, rest[number_end + 1:]))
+                continue
+        head = stripped.lstrip('0123456789')
+        if head != stripped and head[:1] in ('.', ')') and not head[1:2].strip():
+            markers[1].append((index, head[1:]))
+        elif stripped[:1] in ('-', '*') and not stripped[1:2].strip():
+            markers[2].append((index, stripped[1:]))
     
     steps = []
-    for pattern in step_patterns:
-        matches = re.findall(pattern, solution_text, re.MULTILINE | re.DOTALL)
-        if matches and len(matches) > 1:  # Found multiple steps
-            steps = [match.strip() for match in matches if match.strip()]
+    for found in markers:
+        if len(found) > 1:  # Found multiple steps
+            ends = [index for index, _ in found[1:]] + [len(lines)]
+            for (index, first_line), end in zip(found, ends):
+                step = '\n'.join([first_line, *lines[index + 1:end]]).strip()
+                if step:
+                    steps.append(step)
             break
+    if steps:
+        return steps
     
     # If no clear steps found, split by sentences or paragraphs
-    if not steps:
-        # Split by double line breaks (paragraphs)
-        paragraphs = [p.strip() for p in solution_text.split('\n\n') if p.strip()]
-        if len(paragraphs) > 1:
-            steps = paragraphs
-        else:
-            # Split by sentences
-            sentences = [s.strip() for s in re.split(r'[.!?]+', solution_text) if s.strip()]
-            if len(sentences) > 2:
-                steps = sentences[:5]  # Limit to 5 steps for readability
-            else:
-                steps = [solution_text]  # Use entire solution as one step
+    # Split by double line breaks (paragraphs)
+    paragraphs = [p.strip() for p in solution_text.split('\n\n') if p.strip()]
+    if len(paragraphs) > 1:
+        return paragraphs
+    
+    # Split by sentences
+    sentences = [s.strip() for s in _SENTENCE_SPLIT_RE.split(solution_text) if s.strip()]
+    if len(sentences) > 2:
+        return sentences[:5]  # Limit to 5 steps for readability
+    return [solution_text]  # Use entire solution as one step
+
+@functools.lru_cache(maxsize=512)
+def create_solution_with_diagrams(solution_text: str, problem_text: str = "") -> str:
+    """
+    Process the solution text and insert step-by-step diagrams.
+    Breaks down the solution into steps and adds visual diagrams for each.
+    """
+    
+    # Split solution into steps (look for numbered steps, bullet points, or line breaks)
+    steps = _split_steps(solution_text)
     
     # Generate solution with integrated diagrams
-    enhanced_solution = ""
+    parts = []
     
     for i, step in enumerate(steps, 1):
         if not step.strip():
             continue
             
         # Add the step text
-        enhanced_solution += f"""
+        parts.append(f"""
 ### Step {i}
 
 {step}
 
-"""
+""")
         
         # Add step-specific diagram
-        step_diagram = create_step_diagram(step, i, problem_text)
-        enhanced_solution += step_diagram
+        parts.append(create_step_diagram(step, i, problem_text))
         
         # Add separator between steps (except for the last one)
         if i < len(steps):
-            enhanced_solution += "\n---\n"
+            parts.append("\n---\n")
     
-    return enhanced_solution
+    return "".join(parts)
 
 
+# Module prelude (LaTeX cache dir, symbolic step solver) pasted into every generated Manim script
+_MANIM_SCENE_PRELUDE = r'''import functools
+import os
+import re
+import string
+
+from sympy import Eq, Symbol, expand, latex, solve, sstr
+from sympy.parsing.sympy_parser import (
+    convert_xor,
+    implicit_multiplication,
+    parse_expr,
+    standard_transformations,
+)
+
+# Implicit multiplication ("2x") without splitting names into single-letter products
+_TRANSFORMATIONS = standard_transformations + (implicit_multiplication, convert_xor)
+# Every single letter is a plain symbol, so E, I, N, S, ... are not SymPy builtins
+_LETTER_SYMBOLS = {letter: Symbol(letter) for letter in string.ascii_letters}
+_FIRST_LETTER_RE = re.compile(r'[a-zA-Z]')
+_WORD_RE = re.compile(r'[a-zA-Z]{2,}')
+
+# Keep compiled LaTeX across runs so re-renders skip the latex/dvisvgm passes
+config.tex_dir = os.path.join(os.path.expanduser("~"), ".cache", "manim", "Tex")
+# Same for Text: Pango layouts are written once per string, font and size
+config.text_dir = os.path.join(os.path.expanduser("~"), ".cache", "manim", "texts")
+
+
+def _plain(expr):
+    """Plain-text form of a SymPy term for the step captions."""
+    return sstr(expr, full_prec=False).replace("*", "")
+
+
+def _move_term(lhs, rhs, term):
+    """Step that removes ``term`` from both sides of ``lhs = rhs``."""
+    if term.could_extract_minus_sign():
+        explanation, op, shown = f"Add {_plain(-term)} to both sides", "+", -term
+    else:
+        explanation, op, shown = f"Subtract {_plain(term)} from both sides", "-", term
+    return {
+        "explanation": explanation,
+        "equation": f"{latex(lhs)} {op} {latex(shown)} = {latex(rhs)} {op} {latex(shown)}",
+    }
+
+
+@functools.lru_cache(maxsize=128)
+def _solve_steps(equation):
+    """
+    Solve ``equation`` with SymPy and return its steps as a tuple of dicts.
+    Results are cached on the whitespace-normalized equation string.
+    """
+    letter = _FIRST_LETTER_RE.search(equation)
+    name = letter.group(0) if letter else "x"
+    generic = (
+        {"explanation": "Isolate the variable term", "equation": equation},
+        {"explanation": f"Solve for {name}", "equation": f"{name} = ?"},
+    )
+    lhs_text, sep, rhs_text = equation.partition("=")
+    # Multi-letter names are prose or unknown functions ("Total apples = 12 + 8")
+    if not sep or _WORD_RE.search(equation):
+        return generic
+    try:
+        lhs = parse_expr(lhs_text, local_dict=dict(_LETTER_SYMBOLS), transformations=_TRANSFORMATIONS)
+        rhs = parse_expr(rhs_text, local_dict=dict(_LETTER_SYMBOLS), transformations=_TRANSFORMATIONS)
+    except Exception:
+        return generic
+    free = (lhs - rhs).free_symbols
+    if len(free) != 1:
+        return generic
+    (var,) = free
+
+    poly = expand(lhs - rhs).as_poly(var)
+    if poly is None or poly.degree() != 1:
+        try:
+            solutions = solve(Eq(lhs, rhs), var)
+        except Exception:
+            return generic
+        if not solutions:
+            return generic
+        return (
+            {"explanation": "Move all terms to one side", "equation": latex(Eq(expand(lhs - rhs), 0))},
+            {"explanation": "Solution", "equation": f"{latex(var)} = " + ", ".join(latex(s) for s in solutions)},
+        )
+
+    steps = []
+    if not lhs.has(var):
+        lhs, rhs = rhs, lhs
+    # Collect the variable terms on the left, then the constants on the right
+    var_terms = rhs.as_independent(var, as_Add=True)[1]
+    if var_terms != 0:
+        steps.append(_move_term(lhs, rhs, var_terms))
+        lhs, rhs = expand(lhs - var_terms), expand(rhs - var_terms)
+        steps.append({"explanation": "Simplify", "equation": f"{latex(lhs)} = {latex(rhs)}"})
+    constant = lhs.as_independent(var, as_Add=True)[0]
+    if constant != 0:
+        steps.append(_move_term(lhs, rhs, constant))
+        lhs, rhs = expand(lhs - constant), expand(rhs - constant)
+        steps.append({"explanation": "Simplify", "equation": f"{latex(lhs)} = {latex(rhs)}"})
+    coefficient = lhs.coeff(var)
+    if coefficient == 1:
+        if steps:
+            steps.pop()  # the last "Simplify" already reads var = value
+    elif coefficient.is_Rational and not coefficient.is_Integer:
+        reciprocal = latex(1 / coefficient)
+        steps.append({
+            "explanation": f"Multiply both sides by {_plain(1 / coefficient)}",
+            "equation": rf"{reciprocal} \cdot {latex(lhs)} = {reciprocal} \cdot {latex(rhs)}",
+        })
+    else:
+        steps.append({
+            "explanation": f"Divide both sides by {_plain(coefficient)}",
+            "equation": rf"\frac{{{latex(lhs)}}}{{{latex(coefficient)}}} = \frac{{{latex(rhs)}}}{{{latex(coefficient)}}}",
+        })
+    steps.append({"explanation": "Solution", "equation": f"{latex(var)} = {latex(rhs / coefficient)}"})
+    return tuple(steps)
+'''
+
+def _equation_class_name(equation: str) -> str:
+    """Scene class name for an equation, stable across runs and processes."""
+    return "Equation_" + hashlib.blake2b(equation.strip().encode('utf-8'), digest_size=5).hexdigest()
+
+@functools.lru_cache(maxsize=256)
 def create_manim_equation_script(equation: str, problem_text: str = "") -> str:
     """
     Generate a Manim Python script to animate the given mathematical equation.
@@ -954,50 +1655,62 @@ def create_manim_equation_script(equation: str, problem_text: str = "") -> str:
     if not equation:
         return "# No equation provided"
     
-    # Extract variable name (default to 'x')
-    import re
-    var_match = re.search(r'([a-zA-Z])', equation)
-    variable = var_match.group(1) if var_match else 'x'
-    
-    # Generate class name from equation
-    class_name = f"Equation_{hash(equation) % 10000}"
+    # Generate a class name that is stable across runs from the equation
+    class_name = _equation_class_name(equation)
     
     # Create the Manim script
     script = f'''from manim import *
+{_MANIM_SCENE_PRELUDE}
 
 class {class_name}(Scene):
+    # Prebuilt mobjects keyed on source and size; the scene only ever adds copies
+    _tex_cache = {{}}
+
+    @classmethod
+    def _get_mathtex(cls, tex, scale):
+        key = ("tex", tex, scale)
+        if key not in cls._tex_cache:
+            cls._tex_cache[key] = MathTex(tex).scale(scale)
+        return cls._tex_cache[key].copy()
+
+    @classmethod
+    def _get_text(cls, text, font_size):
+        key = ("text", text, font_size)
+        if key not in cls._tex_cache:
+            cls._tex_cache[key] = Text(text, font_size=font_size)
+        return cls._tex_cache[key].copy()
+
     def construct(self):
+        # Solve and build every step mobject before the first play, so the LaTeX
+        # compiles are not interleaved with the animations
+        steps = self.solve_equation("{equation}")
+        equations = [self._get_mathtex(step["equation"], 1.5) for step in steps]
+        explanations = [self._get_text(step["explanation"], 24) for step in steps]
+        
         # Title
-        title = Text("Solving: {equation}", font_size=36)
+        title = self._get_text("Solving: {equation}", 36)
         title.to_edge(UP)
         self.play(Write(title))
         self.wait(1)
         
         # Original equation
-        eq1 = MathTex(r"{equation}")
-        eq1.scale(1.5)
+        eq1 = self._get_mathtex(r"{equation}", 1.5)
         self.play(Write(eq1))
         self.wait(2)
         
         # Step-by-step solution
-        steps = self.solve_equation("{equation}")
-        
         current_eq = eq1
-        for i, step in enumerate(steps):
-            # Move current equation up
-            self.play(current_eq.animate.shift(UP * 1.5))
-            
-            # Show step explanation
-            explanation = Text(step["explanation"], font_size=24)
-            explanation.next_to(current_eq, DOWN, buff=0.5)
-            self.play(Write(explanation))
-            self.wait(1)
-            
-            # Show new equation
-            new_eq = MathTex(step["equation"])
-            new_eq.scale(1.5)
+        for i, (explanation, new_eq) in enumerate(zip(explanations, equations)):
+            # Lay out against where the current equation ends up, then move it up
+            # and write the explanation and the new equation in one play
+            explanation.next_to(current_eq, DOWN, buff=0.5).shift(UP * 1.5)
             new_eq.next_to(explanation, DOWN, buff=0.5)
-            self.play(Write(new_eq))
+            self.play(AnimationGroup(
+                current_eq.animate.shift(UP * 1.5),
+                Write(explanation),
+                Write(new_eq),
+                lag_ratio=0.5,
+            ))
             self.wait(2)
             
             # Clean up for next step
@@ -1015,26 +1728,7 @@ class {class_name}(Scene):
         Parse and solve the equation step by step.
         Returns a list of steps with explanations.
         """
-        steps = []
-        
-        # Simple linear equation solver for demonstration
-        # This is a basic implementation - could be enhanced with sympy
-        
-        if "2x + 5 = 15" in equation:
-            steps = [
-                {{"explanation": "Subtract 5 from both sides", "equation": r"2x + 5 - 5 = 15 - 5"}},
-                {{"explanation": "Simplify", "equation": r"2x = 10"}},
-                {{"explanation": "Divide both sides by 2", "equation": r"\\\\frac{{2x}}{{2}} = \\\\frac{{10}}{{2}}"}},
-                {{"explanation": "Solution", "equation": r"{variable} = 5"}}
-            ]
-        else:
-            # Generic steps for other equations
-            steps = [
-                {{"explanation": "Isolate the variable term", "equation": equation}},
-                {{"explanation": "Solve for {variable}", "equation": f"{variable} = ?"}}
-            ]
-        
-        return steps
+        return [dict(step) for step in _solve_steps(" ".join(equation.split()))]
 
 # To render this animation, run:
 # manim -pql {class_name.lower()}.py {class_name}
@@ -1053,145 +1747,99 @@ def extract_equations_from_text(text: str) -> List[str]:
     Returns:
         List of extracted equations
     """
+    # Every pattern below requires an equals sign
+    if '=' not in text:
+        return []
+    
     equations = []
     
     # Pattern 1: Equations with equals sign
-    eq_pattern1 = r'([a-zA-Z0-9\s\+\-\*\/\(\)]+\s*=\s*[a-zA-Z0-9\s\+\-\*\/\(\)]+)'
-    matches1 = re.findall(eq_pattern1, text)
-    equations.extend(matches1)
+    equations.extend(_EQ_ASSIGN_RE.findall(text))
     
     # Pattern 2: Equations in brackets or parentheses
-    eq_pattern2 = r'[\[\(]([^[\]()]*=+[^[\]()]*?)[\]\)]'
-    matches2 = re.findall(eq_pattern2, text)
-    equations.extend(matches2)
+    equations.extend(_EQ_BRACKET_RE.findall(text))
     
     # Pattern 3: Mathematical expressions with variables
-    eq_pattern3 = r'([a-zA-Z]\s*[\+\-\*\/]\s*\d+\s*=\s*\d+)'
-    matches3 = re.findall(eq_pattern3, text)
-    equations.extend(matches3)
+    equations.extend(_EQ_VARIABLE_RE.findall(text))
     
     # Clean and deduplicate
+    seen = set()
     cleaned_equations = []
     for eq in equations:
         eq = eq.strip()
-        if eq and eq not in cleaned_equations and '=' in eq:
+        if eq and '=' in eq and eq not in seen:
+            seen.add(eq)
             cleaned_equations.append(eq)
     
     return cleaned_equations
 
 
-def slides_from_explanation(title: str, data: Dict[str, Any]) -> str:
-    """Generate Marp-optimized slide-ready Markdown from explanation data with enhanced formatting."""
-    
-    def render_latex_math(text: str) -> str:
-        """Convert content inside [ ] brackets to LaTeX math notation."""
-        import re
-        # Replace [content] with $content$ for inline math
-        text = re.sub(r'\[([^\]]+)\]', r'$\1$', text)
-        return text
-    
-    if "error" in data:
-        return f"""---
+# Marp front matter and stylesheet shared by every generated slide deck
+_SLIDE_FRONTMATTER_TEMPLATE = """---
 marp: true
 title: "{title}"
 theme: default
 size: 16:9
-class: error
+class: math-lesson
 paginate: true
 header: 'Math Problem Solver'
 footer: 'Generated by AI Question Guide'
+math: mathjax
 ---
 
-# ⚠️ Processing Error
-
-## Problem: {title}
+"""
 
-### Error Details
-{data.get('error', 'Unknown error occurred')}
+# Title-only deck for explanations that carry no content
+_MINIMAL_SLIDE_TEMPLATE = _SLIDE_FRONTMATTER_TEMPLATE + """# 📚 {title}
 
-### Troubleshooting Steps
-1. Check the problem format and content
-2. Verify the model is working correctly  
-3. Review the logs for detailed error information
-4. Try simplifying the problem statement
+No explanation is available for this problem yet.
 
 ---
 """
-    
-    # Extract data with defaults
-    overview = data.get("overview", ["No overview available"])
-    solution = data.get("solution", "No solution available")
-    final_answer = data.get("final_answer", "No answer available")
-    mistakes = data.get("mistakes", ["No common mistakes identified"])
-    practice = data.get("practice", ["No practice problems available"])
-    
-    # Get the original problem text for tape diagram generation
-    problem_text = data.get("problem_text", title)
-    
-    # Apply LaTeX math rendering to all text content
-    title = render_latex_math(title)
-    problem_text = render_latex_math(problem_text)
-    overview = [render_latex_math(obj) for obj in overview]
-    solution = render_latex_math(solution)
-    final_answer = render_latex_math(final_answer)
-    mistakes = [render_latex_math(mistake) for mistake in mistakes]
-    practice = [render_latex_math(prob) for prob in practice]
-    
-    slides = f"""---
-marp: true
-title: "{title}"
-theme: default
-size: 16:9
-class: math-lesson
-paginate: true
-header: 'Math Problem Solver'
-footer: 'Generated by AI Question Guide'
-math: mathjax
----
 
-<style>
-section {{
+_MARP_CSS = """<style>
+section {
     font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
     line-height: 1.6;
     padding: 40px;
-}}
-.math-lesson {{
+}
+.math-lesson {
     background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
     color: white;
-}}
-.learning-objectives {{ 
+}
+.learning-objectives { 
     background: rgba(232, 244, 253, 0.95); 
     padding: 1.5rem; 
     border-radius: 12px; 
     color: #333;
     margin: 1rem 0;
     box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-}}
-.solution-steps {{ 
+}
+.solution-steps { 
     background: rgba(248, 249, 250, 0.95); 
     padding: 1.5rem; 
     border-radius: 12px; 
     color: #333;
     margin: 1rem 0;
     box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-}}
-.common-mistakes {{ 
+}
+.common-mistakes { 
     background: rgba(255, 243, 205, 0.95); 
     padding: 1.5rem; 
     border-radius: 12px; 
     color: #333;
     margin: 1rem 0;
     box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-}}
-.practice-problems {{ 
+}
+.practice-problems { 
     background: rgba(209, 236, 241, 0.95); 
     padding: 1.5rem; 
     border-radius: 12px; 
     color: #333;
     margin: 1rem 0;
     box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-}}
-.final-answer {{ 
+}
+.final-answer { 
     background: rgba(212, 237, 218, 0.95); 
     padding: 1.5rem; 
     border-radius: 12px; 
@@ -1200,10 +1848,10 @@ section {{
     margin: 1rem 0;
     box-shadow: 0 4px 6px rgba(0,0,0,0.1);
     font-size: 1.2em;
-}}
+}
 
 /* Marp-optimized Singapore Math Tape Diagram Styles */
-.tape-diagram {{
+.tape-diagram {
     background: rgba(240, 248, 255, 0.95); 
     padding: 2rem; 
     border-radius: 16px; 
@@ -1215,8 +1863,8 @@ section {{
     flex-direction: column;
     justify-content: center;
     box-shadow: 0 6px 12px rgba(0,0,0,0.15);
-}}
-.tape-container {{
+}
+.tape-container {
     display: flex;
     flex-direction: column;
     align-items: center;
@@ -1224,15 +1872,15 @@ section {{
     margin: 1.5rem 0;
     min-height: 200px;
     justify-content: center;
-}}
-.tape-section, .tape-groups {{
+}
+.tape-section, .tape-groups {
     display: flex;
     gap: 15px;
     align-items: center;
     flex-wrap: wrap;
     justify-content: center;
-}}
-.tape-bar {{
+}
+.tape-bar {
     display: flex;
     flex-direction: column;
     justify-content: center;
@@ -1246,14 +1894,14 @@ section {{
     text-align: center;
     font-size: 1.1em;
     padding: 10px;
-}}
-.tape-bar.known {{ background: #90EE90; }}
-.tape-bar.unknown {{ background: #FFB6C1; }}
-.tape-bar.total {{ background: #87CEEB; }}
-.tape-bar.group {{ background: #DDA0DD; }}
-.tape-bar.whole {{ background: #F0E68C; display: flex; flex-direction: row; }}
-.tape-bar.generic {{ background: #D3D3D3; }}
-.tape-part {{
+}
+.tape-bar.known { background: #90EE90; }
+.tape-bar.unknown { background: #FFB6C1; }
+.tape-bar.total { background: #87CEEB; }
+.tape-bar.group { background: #DDA0DD; }
+.tape-bar.whole { background: #F0E68C; display: flex; flex-direction: row; }
+.tape-bar.generic { background: #D3D3D3; }
+.tape-part {
     height: 100%;
     display: flex;
     align-items: center;
@@ -1261,42 +1909,42 @@ section {{
     border-right: 3px solid #333;
     font-size: 1em;
     padding: 5px;
-}}
-.tape-part:last-child {{ border-right: none; }}
-.tape-part.known {{ background: #90EE90; }}
-.tape-part.unknown {{ background: #FFB6C1; }}
-.tape-label {{
+}
+.tape-part:last-child { border-right: none; }
+.tape-part.known { background: #90EE90; }
+.tape-part.unknown { background: #FFB6C1; }
+.tape-label {
     font-size: 0.9em;
     color: #333;
     margin-bottom: 5px;
     font-weight: 600;
-}}
-.tape-value {{
+}
+.tape-value {
     font-size: 1.2em;
     font-weight: bold;
     color: #000;
-}}
-.tape-explanation {{
+}
+.tape-explanation {
     background: rgba(255, 255, 255, 0.95);
     padding: 1.5rem;
     border-radius: 12px;
     border-left: 6px solid #4a90e2;
     margin-top: 1.5rem;
     box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-}}
-.tape-total, .tape-labels {{
+}
+.tape-total, .tape-labels {
     margin-top: 15px;
     text-align: center;
     font-size: 1.1em;
-}}
-.whole-label {{
+}
+.whole-label {
     font-weight: bold;
     color: #333;
     font-size: 1.1em;
-}}
+}
 
 /* Marp-optimized Step Diagram Styles */
-.step-diagram {{
+.step-diagram {
     background: rgba(248, 249, 250, 0.95);
     padding: 2rem;
     border-radius: 16px;
@@ -1308,14 +1956,14 @@ section {{
     display: flex;
     flex-direction: column;
     justify-content: center;
-}}
-.step-diagram h5 {{
+}
+.step-diagram h5 {
     color: #28a745;
     margin-bottom: 1.5rem;
     font-size: 1.4em;
     text-align: center;
-}}
-.operation-visual {{
+}
+.operation-visual {
     display: flex;
     align-items: center;
     justify-content: center;
@@ -1323,36 +1971,36 @@ section {{
     flex-wrap: wrap;
     margin: 1.5rem 0;
     min-height: 100px;
-}}
-.operation-symbol, .equals {{
+}
+.operation-symbol, .equals {
     font-size: 2em;
     font-weight: bold;
     color: #333;
     padding: 0 15px;
-}}
-.tape-bar.operand {{ background: #e3f2fd; border-color: #1976d2; }}
-.tape-bar.result {{ background: #e8f5e8; border-color: #388e3c; }}
-.tape-bar.minuend {{ background: #fff3e0; border-color: #f57c00; }}
-.tape-bar.subtrahend {{ background: #ffebee; border-color: #d32f2f; }}
-.tape-bar.dividend {{ background: #f3e5f5; border-color: #7b1fa2; }}
-.tape-bar.step-info {{ background: #e1f5fe; border-color: #0277bd; }}
-.multiplication-groups, .division-groups {{
+}
+.tape-bar.operand { background: #e3f2fd; border-color: #1976d2; }
+.tape-bar.result { background: #e8f5e8; border-color: #388e3c; }
+.tape-bar.minuend { background: #fff3e0; border-color: #f57c00; }
+.tape-bar.subtrahend { background: #ffebee; border-color: #d32f2f; }
+.tape-bar.dividend { background: #f3e5f5; border-color: #7b1fa2; }
+.tape-bar.step-info { background: #e1f5fe; border-color: #0277bd; }
+.multiplication-groups, .division-groups {
     display: flex;
     gap: 12px;
     margin: 15px 0;
     flex-wrap: wrap;
     justify-content: center;
-}}
-.tape-group {{
+}
+.tape-group {
     display: flex;
     flex-direction: column;
     align-items: center;
     gap: 8px;
-}}
-.multiplication-result {{
+}
+.multiplication-result {
     margin-top: 20px;
-}}
-.step-explanation {{
+}
+.step-explanation {
     background: rgba(255, 255, 255, 0.95);
     padding: 1.5rem;
     border-radius: 12px;
@@ -1360,25 +2008,28 @@ section {{
     margin-top: 1.5rem;
     font-size: 1em;
     box-shadow: 0 4px 6px rgba(0,0,0,0.1);
-}}
+}
 
 /* Marp slide-specific optimizations */
-section.math-lesson h1 {{
+section.math-lesson h1 {
     font-size: 2.5em;
     text-align: center;
     margin-bottom: 1rem;
     text-shadow: 2px 2px 4px rgba(0,0,0,0.3);
-}}
-section.math-lesson h2 {{
+}
+section.math-lesson h2 {
     font-size: 2em;
     margin-bottom: 1rem;
     text-shadow: 1px 1px 2px rgba(0,0,0,0.3);
-}}
-section.math-lesson h3 {{
+}
+section.math-lesson h3 {
     font-size: 1.5em;
     margin-bottom: 0.8rem;
-}}
-</style>
+}
+</style>"""
+
+# Full lesson deck; the stylesheet is passed in as {css} because it contains braces
+_SLIDE_TEMPLATE = _SLIDE_FRONTMATTER_TEMPLATE + """{css}
 
 # 📚 {title}
 
@@ -1388,15 +2039,7 @@ section.math-lesson h3 {{
 
 <div class="learning-objectives">
 
-"""
-    
-    for i, obj in enumerate(overview, 1):
-        slides += f"{i}. {obj}\n"
-    
-    # Generate and include tape diagram
-    tape_diagram = create_tape_diagram(problem_text, solution)
-    
-    slides += f"""
+{overview_block}
 </div>
 
 ---
@@ -1413,7 +2056,7 @@ section.math-lesson h3 {{
 
 ### Solution Process
 
-{create_solution_with_diagrams(solution, problem_text)}
+{solution_steps}
 
 </div>
 
@@ -1433,12 +2076,7 @@ section.math-lesson h3 {{
 
 <div class="common-mistakes">
 
-"""
-    
-    for mistake in mistakes:
-        slides += f"- {mistake}\n"
-    
-    slides += f"""
+{mistakes_block}
 </div>
 
 ---
@@ -1447,12 +2085,7 @@ section.math-lesson h3 {{
 
 <div class="practice-problems">
 
-"""
-    
-    for i, prob in enumerate(practice, 1):
-        slides += f"**Problem {i}:** {prob}\n\n"
-    
-    slides += f"""
+{practice_block}
 </div>
 
 ---
@@ -1461,30 +2094,131 @@ section.math-lesson h3 {{
 
 - **Key Concept:** {title}
 - **Visual Strategy:** Use tape diagrams to represent relationships
-- **Main Strategy:** {solution.split('.')[0] if solution else 'Problem-solving approach'}
+- **Main Strategy:** {main_strategy}
 - **Final Answer:** {final_answer}
 - **Next Steps:** Practice the provided problems and identify any remaining questions
 
 ---
 
 *Generated by AI Question Guide Generator with Singapore Math Visualization*
+"""
+
+def slides_from_explanation(title: str, data: Dict[str, Any]) -> str:
+    """Generate Marp-optimized slide-ready Markdown from explanation data with enhanced formatting."""
+    
+    if "error" in data:
+        return f"""---
+marp: true
+title: "{title}"
+theme: default
+size: 16:9
+class: error
+paginate: true
+header: 'Math Problem Solver'
+footer: 'Generated by AI Question Guide'
+---
+
+# ⚠️ Processing Error
+
+## Problem: {title}
+
+### Error Details
+{data.get('error', 'Unknown error occurred')}
+
+### Troubleshooting Steps
+1. Check the problem format and content
+2. Verify the model is working correctly  
+3. Review the logs for detailed error information
+4. Try simplifying the problem statement
+
+---
 """
     
-    return slides
+    # Extract data with defaults
+    overview = data.get("overview", ["No overview available"])
+    solution = data.get("solution", "No solution available")
+    final_answer = data.get("final_answer", "No answer available")
+    mistakes = data.get("mistakes", ["No common mistakes identified"])
+    practice = data.get("practice", ["No practice problems available"])
+    
+    # Nothing to explain: skip the stylesheet, diagrams and step splitting
+    if solution == "No solution available" and overview == ["No overview available"]:
+        return _MINIMAL_SLIDE_TEMPLATE.format(title=render_latex_math(title))
+    
+    # Get the original problem text for tape diagram generation
+    problem_text = data.get("problem_text", title)
+    
+    # Apply LaTeX math rendering to all text content
+    title = render_latex_math(title)
+    problem_text = render_latex_math(problem_text)
+    overview = [render_latex_math(obj) for obj in overview]
+    solution = render_latex_math(solution)
+    final_answer = render_latex_math(final_answer)
+    mistakes = [render_latex_math(mistake) for mistake in mistakes]
+    practice = [render_latex_math(prob) for prob in practice]
+    
+    # Generate the tape diagram and the step-by-step solution
+    tape_diagram = create_tape_diagram(problem_text, solution)
+    solution_steps = create_solution_with_diagrams(solution, problem_text)
+    
+    return _SLIDE_TEMPLATE.format_map({
+        "css": _MARP_CSS,
+        "title": title,
+        "overview_block": "".join(f"{i}. {obj}\n" for i, obj in enumerate(overview, 1)),
+        "tape_diagram": tape_diagram,
+        "solution_steps": solution_steps,
+        "final_answer": final_answer,
+        "mistakes_block": "".join(f"- {mistake}\n" for mistake in mistakes),
+        "practice_block": "".join(f"**Problem {i}:** {prob}\n\n" for i, prob in enumerate(practice, 1)),
+        "main_strategy": solution.split('.')[0] if solution else 'Problem-solving approach',
+    })
+
+def _is_linear_rational(expr) -> bool:
+    """True for atoms and sums of rational multiples of symbols, which simplify leaves unchanged."""
+    terms = expr.args if expr.is_Add else (expr,)
+    return all(
+        term.is_Atom
+        or (term.is_Mul and len(term.args) == 2 and term.args[0].is_Rational and term.args[1].is_Symbol)
+        for term in terms
+    )
+
+@functools.lru_cache(maxsize=None)
+def _load_sympy():
+    """Import the optional sympy package on first use; it is slow to import."""
+    try:
+        import sympy
+    except Exception:  # pragma: no cover
+        return None
+    return sympy
 
 def try_sympy_check(expr_text: str) -> str | None:
     """Optional SymPy validation of mathematical expressions."""
+    sp = _load_sympy()
     if sp is None:
         return None
     
     try:
-        # Clean the expression
-        cleaned = re.sub(r'[^\w\s\+\-\*/\(\)\^\.\=]', '', expr_text)
-        if not cleaned.strip():
+        # Clean the expression (translate covers the common ASCII-only case)
+        if expr_text.isascii():
+            cleaned = expr_text.translate(_SYMPY_ASCII_DELETE)
+        else:
+            cleaned = _SYMPY_DISALLOWED_RE.sub('', expr_text)
+        # Prose answers without digits or operators cannot parse as an expression
+        if not _SYMPY_MATHLIKE_RE.search(cleaned):
             return None
         
         # Try to parse and evaluate
         expr = sp.sympify(cleaned)
+        
+        # simplify is by far the slowest step; skip it when it cannot change the expression
+        if _is_linear_rational(expr):
+            return f"SymPy validation: Expression is valid"
+        
+        # simplify can take exponential time on large expressions, and signal-based
+        # timeouts are unavailable in the worker threads this runs on
+        if sp.count_ops(expr) > _SYMPY_MAX_SIMPLIFY_OPS:
+            return None
+        
         simplified = sp.simplify(expr)
         
         if expr != simplified:
@@ -1495,6 +2229,16 @@ def try_sympy_check(expr_text: str) -> str | None:
     except Exception:
         return None
 
+def _remove_prefix_ci(text: str, prefix: str) -> str:
+    """Remove a lower-case prefix from text, ignoring the case of the text."""
+    if text[:len(prefix)].lower() == prefix:
+        return text[len(prefix):]
+    return text
+
+def _strip_bullet(line: str, emoji: str = "") -> str:
+    """Remove a leading bullet or list number, then any of the given emoji, from a list line."""
+    return line.lstrip('-*0123456789.').lstrip().lstrip(emoji).strip()
+
 def parse_markdown_response(text: str, problem_text: str = "") -> Dict[str, Any]:
     """Parse markdown response into structured data."""
     
@@ -1517,18 +2261,16 @@ def parse_markdown_response(text: str, problem_text: str = "") -> Dict[str, Any]
     # First, let's extract sections using a more comprehensive approach
     # Find all section headers and their positions
     # Support both ## and ### headers, including those with underscores
-    section_pattern = r'^\s*(?:##|###)[\s_]*([^#\n]+)'
     sections_info = []
     
-    for match in re.finditer(section_pattern, text, re.MULTILINE):
+    for match in _SECTION_RE.finditer(text):
         start_pos = match.start()
         header = match.group(1).strip()
         sections_info.append((start_pos, header, match.group(0)))
     
     # Also look for numbered main sections like "4. **Final Answer:**" at the start of lines
     # but only if they appear to be main sections (not subsections within content)
-    numbered_main_pattern = r'^(\d+)\.\s*\*\*([^*]+)\*\*:?\s*$'
-    for match in re.finditer(numbered_main_pattern, text, re.MULTILINE):
+    for match in _NUMBERED_MAIN_RE.finditer(text):
         start_pos = match.start()
         header = match.group(2).strip()
         # Only add if it's likely a main section (check if it's not inside another section's content)
@@ -1561,9 +2303,8 @@ def parse_markdown_response(text: str, problem_text: str = "") -> Dict[str, Any]
         else:
             content = text[start_pos:]
         
-        # Remove the header line from content
-        content_lines = content.split('\n')[1:]  # Skip first line (header)
-        content_text = '\n'.join(content_lines).strip()
+        # Remove the header line from content (the match can start on blank lines above it)
+        content_text = content.lstrip().partition('\n')[2].strip()  # Skip first line (header)
         
         # Process based on header type
         header_clean = header.lower().strip().replace('_', ' ').replace(':', '').strip()
@@ -1574,10 +2315,10 @@ def parse_markdown_response(text: str, problem_text: str = "") -> Dict[str, Any]
             result["solution"] = content_text
         elif 'common mistake' in header_clean or header_clean == 'mistakes' or header_clean == 'commonmistakes':
             # Parse mistakes content
-            for line in content_text.split('\n'):
-                line = line.strip()
-                if line.startswith(('- ', '* ', '1. ', '2. ', '3. ')):
-                    clean_line = re.sub(r'^[-*\d.]+\s*[🚫❌⚠️]*\s*', '', line).strip()
+            for line_match in _BULLET_LINE_RE.finditer(content_text):
+                line = line_match.group(0).strip()
+                if line.startswith(_BULLET_PREFIXES):
+                    clean_line = _strip_bullet(line, _MISTAKE_EMOJI)
                     if clean_line:
                         result["mistakes"].append(clean_line)
                 elif line and '**' in line and 'mistake' in line.lower():
@@ -1593,10 +2334,10 @@ def parse_markdown_response(text: str, problem_text: str = "") -> Dict[str, Any]
                 result["mistakes"].append(content_text)
         elif 'practice' in header_clean or header_clean == 'practiceproblems':
             # Parse practice problems content
-            for line in content_text.split('\n'):
-                line = line.strip()
-                if line.startswith(('- ', '* ', '1. ', '2. ', '3. ')):
-                    clean_line = re.sub(r'^[-*\d.]+\s*[📝✏️📋]*\s*', '', line).strip()
+            for line_match in _BULLET_LINE_RE.finditer(content_text):
+                line = line_match.group(0).strip()
+                if line.startswith(_BULLET_PREFIXES):
+                    clean_line = _strip_bullet(line, _PRACTICE_EMOJI)
                     if clean_line:
                         result["practice"].append(clean_line)
                 elif line and '**' in line:
@@ -1616,142 +2357,76 @@ def parse_markdown_response(text: str, problem_text: str = "") -> Dict[str, Any]
     # Fallback: try regex-based extraction for missed sections
     if not result["final_answer"]:
         # Look for boxed answers at the end of content
-        boxed_match = re.search(r'\boxed\{([^}]+)\}', text)
+        boxed_match = _BOXED_RE.search(text)
         if boxed_match:
             result["final_answer"] = boxed_match.group(1).strip()
         else:
             # Original fallback
-            final_answer_match = re.search(r'(?:\d+\.\s*)?\*\*\s*Final Answer\s*\*\*:?\s*(.*?)(?=\n\s*(?:\d+\.\s*)?\*\*|\n\s*##|\Z)', text, re.DOTALL | re.IGNORECASE)
+            final_answer_match = _FINAL_ANSWER_RE.search(text)
             if final_answer_match:
                 result["final_answer"] = final_answer_match.group(1).strip()
     
     if not result["mistakes"]:
-        mistakes_match = re.search(r'##_?common_?mistakes?\s*(.*?)(?=##|\Z)', text, re.DOTALL | re.IGNORECASE)
+        mistakes_match = _MISTAKES_SECTION_RE.search(text)
         if mistakes_match:
             mistakes_content = mistakes_match.group(1).strip()
-            for line in mistakes_content.split('\n'):
-                line = line.strip()
+            for line_match in _BULLET_LINE_RE.finditer(mistakes_content):
+                line = line_match.group(0).strip()
                 if line.startswith(('- ', '* ')) and 'mistake' in line.lower():
-                    clean_line = re.sub(r'^[-*]+\s*\*\*Common mistake:\*\*\s*', '', line).strip()
+                    clean_line = _COMMON_MISTAKE_BULLET_RE.sub('', line).strip()
                     if clean_line:
                         result["mistakes"].append(clean_line)
     
     if not result["practice"]:
-        practice_match = re.search(r'##_?practice_?problems?\s*(.*?)(?=##|\Z)', text, re.DOTALL | re.IGNORECASE)
+        practice_match = _PRACTICE_SECTION_RE.search(text)
         if practice_match:
             practice_content = practice_match.group(1).strip()
-            for line in practice_content.split('\n'):
-                line = line.strip()
-                if line.startswith(('- ', '1. ', '2. ', '3. ', '* ')):
-                    clean_line = re.sub(r'^[-*\d.]+\s*[📝✏️📋]*\s*', '', line).strip()
+            for line_match in _BULLET_LINE_RE.finditer(practice_content):
+                line = line_match.group(0).strip()
+                if line.startswith(_BULLET_PREFIXES):
+                    clean_line = _strip_bullet(line, _PRACTICE_EMOJI)
                     if clean_line:
                         result["practice"].append(clean_line)
     
-    # Legacy section processing (keeping for compatibility)
-    sections = re.split(r'^(?:##[\s_]+|\d+\.\s*\*\*)', text, flags=re.MULTILINE)
-    
-    for section in sections:
-        if not section.strip():
-            continue
-            
-        lines = section.strip().split('\n')
-        if not lines:
-            continue
-            
-        # Clean header by removing underscores and normalizing
-        header = lines[0].lower().strip().replace('_', ' ')
-        # Remove bold formatting from headers
-        header = re.sub(r'\*\*([^*]*)\*\*', r'\1', header).strip()
-        content_lines = lines[1:] if len(lines) > 1 else []
-        
+    if not result["overview"]:
+        # Responses sometimes open with a bare "Overview" line before the first section
+        section_match = _SECTION_START_RE.search(text)
+        lines = text[:section_match.start() if section_match else len(text)].strip().split('\n')
+        header = _BOLD_RE.sub(r'\1', lines[0].lower().strip().replace('_', ' ')).strip()
         if header == 'overview':
-            # Extract content - handle both bullet points and paragraph text
-            content_text = '\n'.join(content_lines).strip()
-            if content_text:
-                # Split by sentences or meaningful chunks for overview
-                sentences = [s.strip() for s in content_text.split('.') if s.strip()]
-                result["overview"] = [s + '.' for s in sentences if len(s) > 10]  # Filter out very short fragments
-                    
-        elif header == 'solution':
-            # Join all content as solution text
-            if not result["solution"]:  # Only set if not already extracted above
-                result["solution"] = '\n'.join(content_lines).strip()
-            
-        elif header in ['final answer', 'answer']:
-            # Join all content as final answer
-            if not result["final_answer"]:  # Only set if not already extracted above
-                result["final_answer"] = '\n'.join(content_lines).strip()
-            
-        elif header in ['common mistakes', 'mistakes']:
-            # Extract mistakes - handle both bullet points and numbered items
-            for line in content_lines:
-                line = line.strip()
-                if line.startswith(('- ', '1. ', '2. ', '3. ', '* ')):
-                    # Remove bullet/number and emoji if present
-                    clean_line = re.sub(r'^[-*\d.]+\s*[🚫❌⚠️]*\s*', '', line).strip()
-                    if clean_line:
-                        result["mistakes"].append(clean_line)
-                elif line and not line.startswith('#') and '**' in line:
-                    # Handle bold formatted mistakes - preserve content after colon
-                    if ':' in line:
-                        parts = line.split(':', 1)
-                        if len(parts) > 1:
-                            clean_line = parts[1].strip()
-                            if clean_line:
-                                result["mistakes"].append(clean_line)
-                    else:
-                        clean_line = re.sub(r'\*\*([^*]*)\*\*', r'\1', line).strip()
-                        if clean_line:
-                            result["mistakes"].append(clean_line)
-                    
-        elif header in ['practice problems', 'practice']:
-            # Skip if already extracted above
-            if not result["practice"]:
-                # Extract practice problems - handle both bullet points and numbered items
-                for line in content_lines:
-                    line = line.strip()
-                    if line.startswith(('- ', '1. ', '2. ', '3. ', '* ')):
-                        # Remove bullet/number and emoji if present
-                        clean_line = re.sub(r'^[-*\d.]+\s*[📝✏️📋]*\s*', '', line).strip()
-                        if clean_line:
-                            result["practice"].append(clean_line)
-                    elif line and not line.startswith('#') and '**' in line:
-                        # Handle bold formatted practice problems
-                        if ':' in line:
-                            parts = line.split(':', 1)
-                            if len(parts) > 1:
-                                clean_line = parts[1].strip()
-                                if clean_line:
-                                    result["practice"].append(clean_line)
-                        else:
-                            clean_line = re.sub(r'\*\*([^*]*)\*\*', r'\1', line).strip()
-                            if clean_line and not clean_line.lower().startswith('practice'):
-                                result["practice"].append(clean_line)
+            content_text = '\n'.join(lines[1:]).strip()
+            sentences = [s.strip() for s in content_text.split('.') if s.strip()]
+            result["overview"] = [s + '.' for s in sentences if len(s) > 10]
     
     # Clean up extracted content
     # Fix final_answer formatting
     if result["final_answer"]:
-        # Remove leading bullet points and clean up
-        result["final_answer"] = re.sub(r'^[-*•]\s*', '', result["final_answer"]).strip()
-        # Fix escaped characters in LaTeX
-        result["final_answer"] = result["final_answer"].replace('\\(', '\\(').replace('\\)', '\\)')
-        result["final_answer"] = result["final_answer"].replace('\x08oxed', '\\boxed')
+        # Remove a leading bullet point (not bold/italic markup or a minus sign) and clean up
+        final_answer = result["final_answer"]
+        if final_answer[0] in '-*•' and final_answer[1:2].isspace():
+            final_answer = final_answer[1:]
+        # Fix "\b" in "\boxed" that was decoded as a backspace character
+        result["final_answer"] = final_answer.strip().replace('\x08oxed', '\\boxed')
     
     # Clean up mistakes
+    seen = set()
     cleaned_mistakes = []
     for mistake in result["mistakes"]:
         # Remove "Common mistake:" prefix if present
-        clean_mistake = re.sub(r'^\*\*Common mistake:\*\*\s*', '', mistake, flags=re.IGNORECASE).strip()
-        clean_mistake = re.sub(r'^Common mistake:\s*', '', clean_mistake, flags=re.IGNORECASE).strip()
-        if clean_mistake and clean_mistake not in cleaned_mistakes:
+        clean_mistake = _remove_prefix_ci(mistake, '**common mistake:**').strip()
+        clean_mistake = _remove_prefix_ci(clean_mistake, 'common mistake:').strip()
+        if clean_mistake and clean_mistake not in seen:
+            seen.add(clean_mistake)
             cleaned_mistakes.append(clean_mistake)
     result["mistakes"] = cleaned_mistakes
     
     # Clean up practice problems
+    seen = set()
     cleaned_practice = []
     for practice in result["practice"]:
         clean_practice = practice.strip()
-        if clean_practice and clean_practice not in cleaned_practice:
+        if clean_practice and clean_practice not in seen:
+            seen.add(clean_practice)
             cleaned_practice.append(clean_practice)
     result["practice"] = cleaned_practice
     
@@ -1771,46 +2446,46 @@ def extract_markdown_fallback(text: str, problem_text: str = "") -> Dict[str, An
         "manim_scripts": []  # Initialize empty Manim scripts array
     }
     
-    # Try to find overview section
-    overview_match = re.search(r'(?:## Overview|Overview)(.*?)(?=##|\Z)', text, re.DOTALL | re.IGNORECASE)
-    if overview_match:
-        overview_text = overview_match.group(1)
-        for line in overview_text.split('\n'):
-            line = line.strip()
-            if line.startswith('- '):
-                result["overview"].append(line[2:].strip())
-    
-    # Try to find solution section
-    solution_match = re.search(r'(?:## Solution|Solution)(.*?)(?=##|\Z)', text, re.DOTALL | re.IGNORECASE)
-    if solution_match:
-        result["solution"] = solution_match.group(1).strip()
-    
-    # Try to find final answer section
-    answer_match = re.search(r'(?:## Final Answer|Final Answer)(.*?)(?=##|\Z)', text, re.DOTALL | re.IGNORECASE)
-    if answer_match:
-        result["final_answer"] = answer_match.group(1).strip()
-    
-    # Try to find mistakes section
-    mistakes_match = re.search(r'(?:## Common Mistakes|## Mistakes|Common Mistakes|Mistakes)(.*?)(?=##|\Z)', text, re.DOTALL | re.IGNORECASE)
-    if mistakes_match:
-        mistakes_text = mistakes_match.group(1)
-        for line in mistakes_text.split('\n'):
-            line = line.strip()
-            if '🚫' in line:
-                result["mistakes"].append(line.replace('- ', '').replace('🚫', '').strip())
-    
-    # Try to find practice section
-    practice_match = re.search(r'(?:## Practice Problems|## Practice|Practice Problems|Practice)(.*?)(?=##|\Z)', text, re.DOTALL | re.IGNORECASE)
-    if practice_match:
-        practice_text = practice_match.group(1)
-        for line in practice_text.split('\n'):
-            line = line.strip()
-            if '📝' in line:
-                result["practice"].append(line.replace('- ', '').replace('📝', '').strip())
+    # Locate the first occurrence of every section name in a single pass;
+    # each section runs until the next "##" or the end of the text
+    sections = {}
+    for match in _FALLBACK_SECTION_RE.finditer(text):
+        name = _FALLBACK_SECTIONS[match.lastindex - 1]
+        if name not in sections:
+            start = match.end(match.lastindex)
+            end = text.find('##', start)
+            sections[name] = text[start:end if end != -1 else len(text)]
+            if len(sections) == len(_FALLBACK_SECTIONS):
+                break
+    
+    if "overview" in sections:
+        result["overview"] = [m.group(1) for m in _FALLBACK_DASH_ITEM_RE.finditer(sections["overview"])]
+    
+    if "solution" in sections:
+        result["solution"] = sections["solution"].strip()
+    
+    if "final_answer" in sections:
+        result["final_answer"] = sections["final_answer"].strip()
+    
+    if "mistakes" in sections:
+        result["mistakes"] = [
+            m.group(0).strip().replace('- ', '').replace('🚫', '').strip()
+            for m in _FALLBACK_MISTAKE_LINE_RE.finditer(sections["mistakes"])
+        ]
+    
+    if "practice" in sections:
+        result["practice"] = [
+            m.group(0).strip().replace('- ', '').replace('📝', '').strip()
+            for m in _FALLBACK_PRACTICE_LINE_RE.finditer(sections["practice"])
+        ]
     
     return result
 
 
+def _escape_json_string(match: re.Match) -> str:
+    """Escape raw control whitespace in one matched JSON string literal."""
+    return match.group(0).translate(_JSON_ESCAPE_TABLE)
+
 def clean_json_text(json_text: str) -> str:
     """Clean common JSON formatting issues."""
     try:
@@ -1818,11 +2493,13 @@ def clean_json_text(json_text: str) -> str:
         cleaned = json_text.replace("'", '"')
         
         # Remove trailing commas before closing braces/brackets
-        cleaned = re.sub(r',\s*}', '}', cleaned)
-        cleaned = re.sub(r',\s*]', ']', cleaned)
+        cleaned = _TRAILING_COMMA_OBJ_RE.sub('}', cleaned)
+        cleaned = _TRAILING_COMMA_ARR_RE.sub(']', cleaned)
         
-        # Fix common escape issues
-        cleaned = cleaned.replace('\n', '\\n').replace('\t', '\\t')
+        # Escape raw newlines and tabs inside string values; ones between tokens are
+        # valid JSON whitespace and must stay as they are
+        if '\n' in cleaned or '\t' in cleaned:
+            cleaned = _JSON_STRING_RE.sub(_escape_json_string, cleaned)
         
         # Remove any non-JSON content before the first brace
         first_brace = cleaned.find('{')
@@ -1854,14 +2531,8 @@ def extract_data_manually(text: str, problem_text: str = "") -> Dict[str, Any]:
         
         # Extract the main solution content
         # Look for step-by-step solution or main mathematical content
-        solution_patterns = [
-            r'\*\*Step-by-Step Solution:\*\*(.*?)(?=\*\*Final Answer|\*\*Common Mistakes|\*\*Practice|$)',
-            r'Step-by-Step Solution:(.*?)(?=Final Answer|Common Mistakes|Practice|$)',
-            r'Solution:(.*?)(?=Answer|Mistakes|Practice|$)',
-        ]
-        
-        for pattern in solution_patterns:
-            match = re.search(pattern, text, re.DOTALL | re.IGNORECASE)
+        for pattern in _MANUAL_SOLUTION_RES:
+            match = pattern.search(text)
             if match:
                 data["solution"] = match.group(1).strip()
                 break
@@ -1869,29 +2540,22 @@ def extract_data_manually(text: str, problem_text: str = "") -> Dict[str, Any]:
         # If no solution section found, use the main content up to final answer
         if not data["solution"]:
             # Take content before "Final Answer" or use all content
-            final_answer_pos = text.lower().find('final answer')
+            final_answer_match = _FINAL_ANSWER_LOC_RE.search(text)
+            final_answer_pos = final_answer_match.start() if final_answer_match else -1
             if final_answer_pos > 0:
                 data["solution"] = text[:final_answer_pos].strip()
             else:
                 data["solution"] = text.strip()
         
         # Extract final answer
-        final_answer_patterns = [
-            r'\\boxed\{([^}]+)\}',
-            r'\*\*Final Answer:\*\*\s*\\?\[?\s*\\?boxed\{([^}]+)\}\s*\\?\]?',
-            r'Final Answer:\s*([^\n\*]+)',
-            r'Answer:\s*([^\n\*]+)',
-            r'Therefore,?\s*([^\n\.]+)',
-        ]
-        
-        for pattern in final_answer_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
+        for pattern in _MANUAL_FINAL_ANSWER_RES:
+            match = pattern.search(text)
             if match:
                 data["final_answer"] = match.group(1).strip()
                 break
         
         # Extract mistakes if present
-        mistakes_match = re.search(r'\*\*Common Mistakes:\*\*(.*?)(?=\*\*Practice|\*\*$|$)', text, re.DOTALL | re.IGNORECASE)
+        mistakes_match = _MANUAL_MISTAKES_RE.search(text)
         if mistakes_match:
             mistakes_text = mistakes_match.group(1)
             # Extract individual mistakes
@@ -1900,7 +2564,7 @@ def extract_data_manually(text: str, problem_text: str = "") -> Dict[str, Any]:
                 data["mistakes"] = [f"🚫 {line}" for line in mistake_lines[:3]]  # Limit to 3 mistakes
         
         # Extract practice problems if present
-        practice_match = re.search(r'\*\*Practice Problems?:\*\*(.*?)$', text, re.DOTALL | re.IGNORECASE)
+        practice_match = _MANUAL_PRACTICE_RE.search(text)
         if practice_match:
             practice_text = practice_match.group(1)
             # Extract individual practice problems
@@ -1920,6 +2584,53 @@ def extract_data_manually(text: str, problem_text: str = "") -> Dict[str, Any]:
             "practice": ["Create similar problems for practice"]
         }
 
+def _split_list_items(text: str, label_re: re.Pattern) -> List[str]:
+    """Split text into list items marked by a leading "-", "*" or "1." or by inline labels."""
+    items = []
+    for line in text.split('\n'):
+        if line[:1] in ('-', '*'):
+            start = 1
+        else:
+            marker = _LIST_NUMBER_RE.match(line) or label_re.search(line)
+            if not marker:
+                continue
+            start = marker.end()
+        
+        # Further labels on the same line start new items
+        for label in label_re.finditer(line, start):
+            items.append(line[start:label.start()])
+            start = label.end()
+        items.append(line[start:])
+    return items
+
+def _extract_balanced_json(text: str) -> Optional[str]:
+    """Return the longest balanced {...} span in text, ignoring braces inside JSON strings."""
+    best = None
+    depth = 0
+    start = 0
+    in_string = False
+    escaped = False
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '{':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif depth:
+            if char == '"':
+                in_string = True
+            elif char == '}':
+                depth -= 1
+                if depth == 0 and (best is None or i + 1 - start > len(best)):
+                    best = text[start:i + 1]
+    return best
+
 def construct_json_from_text(text: str) -> str:
     """Construct JSON from structured text when no JSON block is found."""
     try:
@@ -1933,7 +2644,7 @@ def construct_json_from_text(text: str) -> str:
         }
         
         # Extract solution section
-        solution_match = re.search(r'\*\*Step-by-Step Solution:\*\*(.*?)(?=\*\*|$)', text, re.DOTALL | re.IGNORECASE)
+        solution_match = _BOLD_SOLUTION_SECTION_RE.search(text)
         if solution_match:
             result["solution"] = solution_match.group(1).strip()
         else:
@@ -1941,33 +2652,26 @@ def construct_json_from_text(text: str) -> str:
             result["solution"] = text.strip()
         
         # Extract final answer (look for boxed answers or explicit final answer sections)
-        final_answer_patterns = [
-            r'\\boxed\{([^}]+)\}',
-            r'\*\*Final Answer:\*\*\s*([^\n\*]+)',
-            r'Final Answer:\s*([^\n\*]+)',
-            r'Answer:\s*([^\n\*]+)',
-        ]
-        
-        for pattern in final_answer_patterns:
-            match = re.search(pattern, text, re.IGNORECASE)
+        for pattern in _CONSTRUCT_FINAL_ANSWER_RES:
+            match = pattern.search(text)
             if match:
                 result["final_answer"] = match.group(1).strip()
                 break
         
         # Extract common mistakes
-        mistakes_section = re.search(r'\*\*Common Mistakes:\*\*(.*?)(?=\*\*|$)', text, re.DOTALL | re.IGNORECASE)
+        mistakes_section = _BOLD_MISTAKES_SECTION_RE.search(text)
         if mistakes_section:
             mistakes_text = mistakes_section.group(1)
             # Look for numbered or bulleted mistakes
-            mistake_items = re.findall(r'(?:^\d+\.|^\*|^-|\*\*Mistake \d+:\*\*)(.*?)(?=(?:^\d+\.|^\*|^-|\*\*Mistake \d+:\*\*|$))', mistakes_text, re.MULTILINE | re.DOTALL)
+            mistake_items = _split_list_items(mistakes_text, _MISTAKE_LABEL_RE)
             result["mistakes"] = [f"🚫 {item.strip()}" for item in mistake_items if item.strip()]
         
         # Extract practice problems
-        practice_section = re.search(r'\*\*Practice Problems:\*\*(.*?)(?=\*\*|$)', text, re.DOTALL | re.IGNORECASE)
+        practice_section = _BOLD_PRACTICE_SECTION_RE.search(text)
         if practice_section:
             practice_text = practice_section.group(1)
             # Look for numbered or bulleted practice problems
-            practice_items = re.findall(r'(?:^\d+\.|^\*|^-|\*\*.*?Problem \d+:\*\*)(.*?)(?=(?:^\d+\.|^\*|^-|\*\*.*?Problem \d+:\*\*|$))', practice_text, re.MULTILINE | re.DOTALL)
+            practice_items = _split_list_items(practice_text, _PRACTICE_LABEL_RE)
             result["practice"] = [f"📝 {item.strip()}" for item in practice_items if item.strip()]
         
         # Generate overview based on content
@@ -1984,90 +2688,333 @@ def construct_json_from_text(text: str) -> str:
         logging.error(f"Error constructing JSON from text: {str(e)}")
         return "{}"
 
-def generate_for_problem(model, tokenizer, prob: Problem, args) -> Tuple[Dict[str, Any], str]:
-    """Generate explanation and slides for a problem with comprehensive error handling."""
-    try:
-        logging.info(f"Generating content for problem {prob.index}: {prob.title}")
+def _json_loads(text: str) -> Any:
+    """Decode JSON with orjson when installed; both raise ``json.JSONDecodeError``."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+def _equation_filename(equation: str) -> str:
+    """Script filename for an equation; matches the run command in the script footer."""
+    return f"{_equation_class_name(equation).lower()}.py"
+
+def build_manim_scripts(problem_text: str) -> List[Dict[str, str]]:
+    """Build a Manim script for each equation in a problem."""
+    return [
+        {
+            "equation": eq,
+            "script": create_manim_equation_script(eq, problem_text),
+            "filename": _equation_filename(eq)
+        }
+        for eq in extract_equations_from_text(problem_text)
+    ]
+
+def generation_cache_key(problem_text: str, args) -> str:
+    """Content hash identifying a generated response for a problem under the run's settings.
+    
+    Besides the problem it covers everything that changes the response: model, engine
+    and quantization, the prompt template of the grade level and the decoding parameters.
+    """
+    system_message, user_prefix, user_suffix = _explanation_prompt_parts(getattr(args, 'grade_level', 'middle school'))
+    if getattr(args, 'greedy', False):
+        decoding = "greedy"
+    else:
+        decoding = f"sample:{getattr(args, 'temperature', 0.7)!r}:{getattr(args, 'top_p', 0.9)!r}"
+    key_text = '\0'.join((
+        getattr(args, 'model', ''),
+        getattr(args, 'engine', 'hf'),
+        getattr(args, 'quant', 'none'),
+        system_message["content"],
+        user_prefix,
+        user_suffix,
+        decoding,
+        str(getattr(args, 'max_new_tokens', 1024)),
+        problem_text,
+    ))
+    return hashlib.sha256(key_text.encode('utf-8')).hexdigest()
+
+class SemanticCache:
+    """Raw responses indexed by problem embeddings so near-duplicate problems reuse them.
+    
+    Embeddings come from a small sentence-transformers model and are L2-normalized, so
+    inner product is cosine similarity. Lookups use a FAISS flat index when faiss is
+    installed and a NumPy matrix product otherwise. Entries are kept in
+    ``<namespace>.npy`` / ``<namespace>.jsonl`` under ``directory``; use one namespace per
+    set of generation settings (see ``generation_cache_key``). ``encoder`` replaces the
+    sentence-transformers model with any object providing its ``encode`` and
+    ``get_sentence_embedding_dimension`` methods.
+    """
+    
+    def __init__(self, directory: str, namespace: str, threshold: float = 0.95,
+                 embedding_model: str = "sentence-transformers/all-MiniLM-L6-v2",
+                 encoder: Optional[Any] = None):
+        import numpy as np
+        
+        self._np = np
+        self.threshold = threshold
+        if encoder is None:
+            from sentence_transformers import SentenceTransformer
+            encoder = SentenceTransformer(embedding_model)
+        self.encoder = encoder
+        self.vectors_path = os.path.join(directory, f"{namespace}.npy")
+        self.entries_path = os.path.join(directory, f"{namespace}.jsonl")
+        
+        self.raws: List[str] = []
+        self.vectors = np.zeros((0, self.encoder.get_sentence_embedding_dimension()), dtype=np.float32)
+        if os.path.exists(self.vectors_path) and os.path.exists(self.entries_path):
+            with open(self.entries_path, 'r', encoding='utf-8') as f:
+                self.raws = [json.loads(line)["raw"] for line in f]
+            self.vectors = np.load(self.vectors_path)
+            # An interrupted save can leave the two files out of step
+            count = min(len(self.raws), len(self.vectors))
+            self.raws, self.vectors = self.raws[:count], self.vectors[:count]
+            logging.info(f"Loaded {len(self.raws)} semantic cache entries from {directory}")
         
-        msgs = explanation_prompt(prob.content, getattr(args, 'grade_level', 'middle school'))
-        raw = chat_completion(
+        try:
+            import faiss
+            self.index = faiss.IndexFlatIP(self.vectors.shape[1])
+            if len(self.raws):
+                self.index.add(self.vectors)
+        except ImportError:
+            self.index = None
+        self._saved = len(self.raws)
+    
+    def embed(self, texts: List[str]) -> Any:
+        """Return normalized float32 embeddings, one row per text."""
+        return self.encoder.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(self._np.float32)
+    
+    def lookup(self, embeddings: Any) -> List[Optional[str]]:
+        """Return the cached response of the most similar problem per row, if similar enough."""
+        if not self.raws:
+            return [None] * len(embeddings)
+        if self.index is not None:
+            scores, ids = self.index.search(embeddings, 1)
+            best_scores, best_ids = scores[:, 0], ids[:, 0]
+        else:
+            similarities = embeddings @ self.vectors.T
+            best_ids = similarities.argmax(axis=1)
+            best_scores = similarities[self._np.arange(len(embeddings)), best_ids]
+        return [
+            self.raws[i] if score >= self.threshold else None
+            for score, i in zip(best_scores, best_ids)
+        ]
+    
+    def add(self, embeddings: Any, raws: List[str]) -> None:
+        """Store responses under their problem embeddings."""
+        if not raws:
+            return
+        self.raws.extend(raws)
+        self.vectors = self._np.concatenate([self.vectors, embeddings])
+        if self.index is not None:
+            self.index.add(embeddings)
+    
+    def close(self) -> None:
+        """Write the entries to the sidecar files if any were added."""
+        if len(self.raws) == self._saved:
+            return
+        with open(self.entries_path, 'w', encoding='utf-8') as f:
+            for raw in self.raws:
+                f.write(json.dumps({"raw": raw}, ensure_ascii=False) + "\n")
+        self._np.save(self.vectors_path, self.vectors)
+        self._saved = len(self.raws)
+
+def generate_raw_responses(model, tokenizer, probs: List[Problem], args,
+                           cache: Optional[Any] = None,
+                           assistant_model: Optional[Any] = None,
+                           semantic_cache: Optional[SemanticCache] = None) -> List[str]:
+    """Generate the raw model responses for a batch of problems with one batched model call.
+    
+    Problems with identical content are generated once. ``cache`` (a dict or
+    ``diskcache.Cache``) maps content hashes to raw responses from earlier batches or runs.
+    ``assistant_model`` is an optional draft model for speculative decoding.
+    ``semantic_cache`` additionally reuses responses of near-duplicate problems.
+    """
+    logging.info(f"Generating content for {len(probs)} problems: {', '.join(str(p.index) for p in probs)}")
+    
+    grade_level = getattr(args, 'grade_level', 'middle school')
+    keys = [generation_cache_key(prob.content, args) for prob in probs]
+    
+    # Reuse cached responses and collapse duplicates so each distinct problem is generated once
+    raws = {}
+    pending = {}
+    for prob, key in zip(probs, keys):
+        if key in raws or key in pending:
+            continue
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            logging.info(f"Reusing cached response for problem {prob.index}")
+            raws[key] = cached
+        else:
+            pending[key] = prob
+    
+    # Reuse responses of near-duplicate problems
+    pending_embeddings = None
+    if semantic_cache is not None and pending:
+        embeddings = semantic_cache.embed([prob.content for prob in pending.values()])
+        misses = []
+        for row, ((key, prob), hit) in enumerate(zip(list(pending.items()), semantic_cache.lookup(embeddings))):
+            if hit is not None:
+                logging.info(f"Reusing response of a similar problem for problem {prob.index}")
+                raws[key] = hit
+                del pending[key]
+            else:
+                misses.append(row)
+        pending_embeddings = embeddings[misses]
+    
+    if pending:
+        engine = getattr(args, 'engine', 'hf')
+        generation_kwargs = {}
+        if engine != 'hf':
+            completion_fn = engine_completion
+            generation_kwargs['engine'] = engine
+        elif getattr(args, 'continuous_batching', False):
+            completion_fn = continuous_batch_completion
+        else:
+            completion_fn = chat_completion
+            generation_kwargs['assistant_model'] = assistant_model
+        generated = completion_fn(
             model,
             tokenizer,
-            msgs,
+            [explanation_prompt(prob.content, grade_level) for prob in pending.values()],
             max_new_tokens=getattr(args, 'max_new_tokens', 1024),
             temperature=getattr(args, 'temperature', 0.7),
             top_p=getattr(args, 'top_p', 0.9),
+            greedy=getattr(args, 'greedy', False),
+            **generation_kwargs,
         )
-        print(raw)
         
-        # First try to parse as markdown (new approach)
+        succeeded = []
+        for row, (key, raw) in enumerate(zip(pending, generated)):
+            raws[key] = raw
+            # Do not persist failures so they are retried on the next run
+            if not raw.startswith(("Error generating response", "No response generated")):
+                succeeded.append(row)
+                if cache is not None:
+                    cache[key] = raw
+        if semantic_cache is not None:
+            semantic_cache.add(pending_embeddings[succeeded], [generated[row] for row in succeeded])
+    
+    return [raws[key] for key in keys]
+
+def save_problem_output(prob: Problem, args, raw: str, output_dir: str) -> None:
+    """Parse a raw response and write its ``explanation.json`` and ``slides.md`` to ``output_dir``."""
+    data, slides = generate_for_problem(None, None, prob, args, raw=raw)
+    
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Save JSON
+    json_path = os.path.join(output_dir, "explanation.json")
+    if orjson is not None:
+        with open(json_path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+    
+    # Save slides
+    slides_path = os.path.join(output_dir, "slides.md")
+    with open(slides_path, 'w', encoding='utf-8') as f:
+        f.write(slides)
+
+def _try_json_parse(raw: str, prob: Problem) -> Optional[Dict[str, Any]]:
+    """Parse a JSON object with a ``solution`` from a model response, or return None."""
+    # Extract JSON from the model output with robust parsing
+    json_text = None
+    
+    # Prefer a complete JSON object with balanced braces, then a ```json block;
+    # a response without any brace cannot hold a JSON object at all
+    if '{' in raw:
+        json_text = _extract_balanced_json(raw)
+        if json_text:
+            logging.debug(f"Found balanced JSON object: {json_text[:100]}...")
+        else:
+            codeblock_match = _CODEBLOCK_JSON_RE.search(raw)
+            if codeblock_match:
+                json_text = codeblock_match.group(1)
+                logging.debug(f"Found JSON code block: {json_text[:100]}...")
+    
+    # If JSON found, try to parse it
+    if json_text and json_text.strip() != "{}":
         try:
-            logging.info(f"Attempting to parse markdown response for problem {prob.index}")
-            data = parse_markdown_response(raw, prob.content)
+            logging.debug(f"Attempting to parse JSON: {json_text[:200]}...")
+            json_data = _json_loads(json_text)
+            logging.debug(f"Successfully parsed JSON for problem {prob.index}")
+            # Only accept objects that carry a solution
+            if isinstance(json_data, dict) and json_data.get("solution"):
+                return json_data
+        except json.JSONDecodeError as e:
+            logging.warning(f"Failed to parse JSON for problem {prob.index}: {str(e)}")
+            # Try to clean up common JSON issues
+            cleaned_json = clean_json_text(json_text)
             
-            # Check if we got meaningful data
-            if (data.get("solution") or data.get("overview") or 
-                data.get("final_answer") or data.get("mistakes") or data.get("practice")):
-                logging.debug(f"Successfully parsed markdown for problem {prob.index}")
-            else:
+            try:
+                json_data = _json_loads(cleaned_json)
+                logging.debug(f"Successfully parsed cleaned JSON for problem {prob.index}")
+                if isinstance(json_data, dict) and json_data.get("solution"):
+                    return json_data
+            except json.JSONDecodeError as e2:
+                logging.error(f"Could not parse JSON even after cleaning for problem {prob.index}: {str(e2)}")
+    
+    return None
+
+def generate_for_problem(model, tokenizer, prob: Problem, args,
+                         raw: Optional[str] = None) -> Tuple[Dict[str, Any], str]:
+    """Generate explanation and slides for a problem with comprehensive error handling.
+    
+    If ``raw`` is given (e.g. from a batched ``chat_completion`` call) generation is
+    skipped and only the response is parsed.
+    """
+    try:
+        logging.info(f"Generating content for problem {prob.index}: {prob.title}")
+        
+        if raw is None:
+            msgs = explanation_prompt(prob.content, getattr(args, 'grade_level', 'middle school'))
+            raw = chat_completion(
+                model,
+                tokenizer,
+                [msgs],
+                max_new_tokens=getattr(args, 'max_new_tokens', 1024),
+                temperature=getattr(args, 'temperature', 0.7),
+                top_p=getattr(args, 'top_p', 0.9),
+                greedy=getattr(args, 'greedy', False),
+            )[0]
+        # Parsing runs on output pool threads; the log queue keeps responses from interleaving
+        logging.debug(f"Raw response for problem {prob.index}:\n{raw}")
+        
+        # Responses that open with JSON go straight to the JSON parser
+        data = None
+        json_tried = False
+        if raw.lstrip()[:7].lower().startswith(('```json', '{')):
+            logging.info(f"Response starts with JSON, attempting JSON parse for problem {prob.index}")
+            data = _try_json_parse(raw, prob)
+            json_tried = True
+        
+        if data is None:
+            # First try to parse as markdown (new approach)
+            try:
+                logging.info(f"Attempting to parse markdown response for problem {prob.index}")
+                data = parse_markdown_response(raw, prob.content)
+            
+                # Check if we got meaningful data
+                if (data.get("solution") or data.get("overview") or 
+                    data.get("final_answer") or data.get("mistakes") or data.get("practice")):
+                    logging.debug(f"Successfully parsed markdown for problem {prob.index}")
+                else:
+                    # Try fallback markdown parsing
+                    logging.info(f"Primary markdown parsing yielded empty results, trying fallback for problem {prob.index}")
+                    data = extract_markdown_fallback(raw, prob.content)
+                
+            except Exception as e:
+                logging.warning(f"Markdown parsing failed for problem {prob.index}: {str(e)}")
                 # Try fallback markdown parsing
-                logging.info(f"Primary markdown parsing yielded empty results, trying fallback for problem {prob.index}")
                 data = extract_markdown_fallback(raw, prob.content)
-                
-        except Exception as e:
-            logging.warning(f"Markdown parsing failed for problem {prob.index}: {str(e)}")
-            # Try fallback markdown parsing
-            data = extract_markdown_fallback(raw, prob.content)
         
         # If markdown parsing didn't work well, try JSON parsing as fallback
-        if not any([data.get("solution"), data.get("overview"), data.get("final_answer")]):
+        if not json_tried and not any([data.get("solution"), data.get("overview"), data.get("final_answer")]):
             logging.info(f"Markdown parsing unsuccessful, attempting JSON fallback for problem {prob.index}")
-            
-            # Extract JSON from the model output with robust parsing
-            json_text = None
-            
-            # Look for JSON patterns in order of preference
-            patterns = [
-                # Complete JSON object with proper braces
-                r'\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}',
-                # JSON in code blocks
-                r'```json\s*([\s\S]*?)```',
-                r'```\s*(\{[\s\S]*?\})\s*```',
-                # JSON at the end of response
-                r'\{[\s\S]*\}\s*$',
-                # Any JSON-like structure
-                r'\{[\s\S]*?\}',
-            ]
-            
-            for i, pattern in enumerate(patterns):
-                matches = re.findall(pattern, raw, re.MULTILINE | re.DOTALL)
-                if matches:
-                    # Take the longest match (most likely to be complete)
-                    json_text = max(matches, key=len) if isinstance(matches[0], str) else matches[0]
-                    logging.debug(f"Found JSON using pattern {i+1}: {json_text[:100]}...")
-                    break
-            
-            # If JSON found, try to parse it
-            if json_text and json_text.strip() != "{}":
-                try:
-                    print(f"Attempting to parse JSON: {json_text[:200]}...")
-                    json_data = json.loads(json_text)
-                    logging.debug(f"Successfully parsed JSON for problem {prob.index}")
-                    # Use JSON data if it's better than markdown data
-                    if isinstance(json_data, dict) and json_data.get("solution"):
-                        data = json_data
-                except json.JSONDecodeError as e:
-                    logging.warning(f"Failed to parse JSON for problem {prob.index}: {str(e)}")
-                    # Try to clean up common JSON issues
-                    cleaned_json = clean_json_text(json_text)
-                    
-                    try:
-                        json_data = json.loads(cleaned_json)
-                        logging.debug(f"Successfully parsed cleaned JSON for problem {prob.index}")
-                        if isinstance(json_data, dict) and json_data.get("solution"):
-                            data = json_data
-                    except json.JSONDecodeError as e2:
-                        logging.error(f"Could not parse JSON even after cleaning for problem {prob.index}: {str(e2)}")
+            json_data = _try_json_parse(raw, prob)
+            if json_data is not None:
+                data = json_data
         
         # Final fallback if no good data was extracted
         if not any([data.get("solution"), data.get("overview"), data.get("final_answer")]):
@@ -2098,22 +3045,12 @@ def generate_for_problem(model, tokenizer, prob: Problem, args) -> Tuple[Dict[st
             
             # Generate Manim script for equations found in the problem
             try:
-                equations = extract_equations_from_text(prob.content)
-                if equations:
-                    logging.info(f"Found {len(equations)} equations in problem {prob.index}: {equations}")
-                    manim_scripts = []
-                    for eq in equations:
-                        script = create_manim_equation_script(eq, prob.content)
-                        manim_scripts.append({
-                            "equation": eq,
-                            "script": script,
-                            "filename": f"equation_{hash(eq) % 10000}.py"
-                        })
-                    data["manim_scripts"] = manim_scripts
-                    logging.info(f"Generated {len(manim_scripts)} Manim scripts for problem {prob.index}")
+                manim_scripts = build_manim_scripts(prob.content)
+                if manim_scripts:
+                    logging.info(f"Generated {len(manim_scripts)} Manim scripts for problem {prob.index}: {[script['equation'] for script in manim_scripts]}")
                 else:
                     logging.debug(f"No equations found in problem {prob.index}")
-                    data["manim_scripts"] = []
+                data["manim_scripts"] = manim_scripts
             except Exception as e:
                 logging.warning(f"Failed to generate Manim scripts for problem {prob.index}: {str(e)}")
                 data["manim_scripts"] = []
@@ -2125,7 +3062,7 @@ def generate_for_problem(model, tokenizer, prob: Problem, args) -> Tuple[Dict[st
     
     except Exception as e:
         logging.error(f"Error generating content for problem {prob.index}: {str(e)}")
-        logging.error(traceback.format_exc())
+        log_traceback()
         
         # Return error data
         error_data = {
@@ -2144,14 +3081,25 @@ def generate_for_problem(model, tokenizer, prob: Problem, args) -> Tuple[Dict[st
 def main():
     """Main function to orchestrate the lesson generation process."""
     parser = argparse.ArgumentParser(description="AI-powered Question Guidance and Instruction Generation Tool")
-    parser.add_argument("--input", "-i", default='QuestionGuide/math_problems.docx', help="Input file with problems (supports .md, .txt, .docx)")
+    parser.add_argument("--input", "-i", default='QuestionGuide/math_problems.docx', help="Input file with problems (supports .md, .txt, .docx), a directory of such files, or a glob pattern such as 'banks/**/*.md'")
     parser.add_argument("--output", "-o", default="output", help="Output directory for generated lessons")
     parser.add_argument("--model", "-m", default="Qwen/Qwen2.5-Math-7B-Instruct", help="Hugging Face model to use")
     parser.add_argument("--grade-level", "-g", default="elementary", choices=["elementary", "middle school", "high school"], help="Grade level for content adaptation")
     parser.add_argument("--max-new-tokens", type=int, default=2048, help="Maximum generation tokens 1024")
     parser.add_argument("--temperature", type=float, default=0.7, help="Generation temperature")
     parser.add_argument("--top-p", type=float, default=0.9, help="Top-p sampling parameter")
+    parser.add_argument("--greedy", action="store_true", help="Use deterministic greedy decoding instead of sampling")
+    parser.add_argument("--no-cache", action="store_true", help="Do not reuse responses cached by earlier runs (duplicate problems within a run are still generated once)")
+    parser.add_argument("--semantic-cache", action="store_true", help="Reuse responses of near-duplicate problems found by embedding similarity (needs sentence-transformers; faiss optional)")
+    parser.add_argument("--semantic-threshold", type=float, default=0.95, help="Minimum cosine similarity for --semantic-cache hits")
+    parser.add_argument("--batch-size", type=int, default=4, help="Number of problems generated per batched model call (0: all problems in one call)")
+    parser.add_argument("--continuous-batching", action="store_true", help="Submit all problems at once to transformers' continuous batching scheduler")
     parser.add_argument("--device", default="auto", help="Device to use (auto, cpu, cuda)")
+    parser.add_argument("--engine", "--backend", dest="engine", default="hf", choices=["hf", "vllm", "trtllm"], help="Inference engine (Hugging Face generate, vLLM or TensorRT-LLM)")
+    parser.add_argument("--draft-model", default=None, help="Small same-family draft model for speculative decoding, e.g. Qwen/Qwen2.5-Math-1.5B-Instruct (hf engine, one problem at a time)")
+    parser.add_argument("--quant", default="none", choices=["none", "int4", "int8", "awq", "fp8"], help="Weight quantization (int4: bitsandbytes NF4, int8: bitsandbytes LLM.int8(), awq: pre-quantized AWQ checkpoint such as Qwen/Qwen2.5-7B-Instruct-AWQ, fp8: TensorRT-LLM/vLLM)")
+    parser.add_argument("--attn", default="auto", choices=["auto", "flash_attention_2", "sdpa", "eager"], help="Attention implementation for the hf engine (auto: FlashAttention-2 when installed, else SDPA)")
+    parser.add_argument("--torch-compile", action="store_true", help="Compile the model forward with a static KV cache (slower start, faster decode)")
     parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Logging level")
     
     args = parser.parse_args()
@@ -2168,73 +3116,182 @@ def main():
         # Create output directory
         os.makedirs(args.output, exist_ok=True)
         
-        # Read problems from input file
-        problems = read_problems(args.input)
-        if not problems:
-            logging.error("No problems found in input file")
-            return
-        
-        logging.info(f"Found {len(problems)} problems to process")
+        # Read problems from input file. A directory or glob of inputs is parsed in worker
+        # processes while the model loads.
+        parse_pool = None
+        if is_multi_file_input(args.input):
+            input_files = list_problem_files(args.input)
+            logging.info(f"Parsing {len(input_files)} input files from {args.input}")
+            parse_pool = ProcessPoolExecutor(initializer=init_worker_logging)
+            parsed_files = parse_pool.map(read_problems, input_files)
+        else:
+            problems = read_problems(args.input)
+            if not problems:
+                logging.error("No problems found in input file")
+                return
+            
+            logging.info(f"Found {len(problems)} problems to process")
         
         # Build model and tokenizer
-        model, tokenizer = build_model_and_tokenizer(args.model, args.device)
+        if args.quant == "fp8" and args.engine == "hf":
+            logging.info("FP8 quantization is served through TensorRT-LLM, switching engine to trtllm")
+            args.engine = "trtllm"
+        
+        if args.engine == "hf":
+            model, tokenizer = build_model_and_tokenizer(
+                args.model, args.device, torch_compile=args.torch_compile, quant=args.quant,
+                attn=args.attn,
+            )
+        else:
+            model, tokenizer = build_llm_engine(
+                args.model, args.engine, quant=args.quant,
+                max_model_len=_PROMPT_TOKEN_BUDGET + args.max_new_tokens,
+            )
         
-        # Process each problem
-        all_results = []
-        for i, problem in enumerate(problems):
-            logging.info(f"Processing problem {i+1}/{len(problems)}: {problem.title}")
+        # Optional draft model for speculative decoding
+        assistant_model = None
+        if args.draft_model and args.engine == "hf":
+            assistant_model = build_draft_model(args.draft_model, model)
+        
+        if parse_pool is not None:
+            with parse_pool:
+                problems = [problem for file_problems in parsed_files for problem in file_problems]
+            if not problems:
+                logging.error(f"No problems found in input files {args.input}")
+                return
             
+            logging.info(f"Found {len(problems)} problems to process")
+        
+        # Process problems in batches
+        # Cache raw responses by content hash so duplicate problems are generated only once
+        # Duplicates within this run are always generated once; --no-cache only skips
+        # responses stored by earlier runs
+        if not args.no_cache and diskcache is not None:
+            generation_cache = diskcache.Cache(os.path.join(args.output, "gencache"))
+        else:
+            if not args.no_cache:
+                logging.info("diskcache not installed, responses are only reused within this run")
+            generation_cache = {}
+        
+        # Optionally reuse responses of near-duplicate problems across runs
+        semantic_cache = None
+        if args.semantic_cache:
             try:
-                # Generate content for the problem
-                data, slides = generate_for_problem(model, tokenizer, problem, args)
-                
-                # Save individual outputs
-                problem_output_dir = os.path.join(args.output, f"problem_{i+1:02d}")
-                os.makedirs(problem_output_dir, exist_ok=True)
-                
-                # Save JSON
-                json_path = os.path.join(problem_output_dir, "explanation.json")
-                with open(json_path, 'w', encoding='utf-8') as f:
-                    json.dump(data, f, indent=2, ensure_ascii=False)
-                
-                # Save slides
-                slides_path = os.path.join(problem_output_dir, "slides.md")
-                with open(slides_path, 'w', encoding='utf-8') as f:
-                    f.write(slides)
-                
-                all_results.append({
-                    'problem': problem,
-                    'data': data,
-                    'slides': slides
-                })
-                
-                logging.info(f"Problem {i+1} completed successfully")
-                
-            except Exception as e:
-                logging.error(f"Failed to process problem {i+1}: {str(e)}")
-                logging.error(traceback.format_exc())
-                continue
+                semantic_cache = SemanticCache(
+                    args.output,
+                    "semcache_" + generation_cache_key("", args)[:16],
+                    threshold=args.semantic_threshold,
+                )
+            except ImportError:
+                logging.warning("sentence-transformers not installed, semantic cache disabled. Install with: pip install sentence-transformers")
+        
+        # Continuous batching and the vLLM/TensorRT-LLM engines schedule every problem
+        # themselves, so submit them all at once
+        if args.continuous_batching or args.engine != "hf":
+            batch_size = len(problems)
+        elif assistant_model is not None:
+            batch_size = 1
+        elif args.batch_size <= 0:
+            batch_size = len(problems)
+        else:
+            batch_size = args.batch_size
+        
+        # Batch problems of similar token length together so little of each padded
+        # batch is padding; outputs keep their original problem numbers
+        order = list(range(len(problems)))
+        if args.engine == "hf" and 1 < batch_size < len(problems):
+            lengths = [len(ids) for ids in tokenizer([p.content for p in problems], add_special_tokens=False).input_ids]
+            order.sort(key=lengths.__getitem__)
         
-        # Create master README
-        readme_content = f"""# AI Question Guidance Generator Results
+        # Create master README; a line is appended as each problem finishes so
+        # generated content is not kept in memory
+        readme_path = os.path.join(args.output, "README.md")
+        readme_f = open(readme_path, 'w', encoding='utf-8')
+        readme_f.write(f"""# AI Question Guidance Generator Results
 
 Generated on: {time.strftime("%Y-%m-%d %H:%M:%S")}
-Total problems processed: {len(all_results)}
 Model used: {args.model}
 
 ## Generated Content
 
 Each problem has been processed and saved in its own directory:
 
-"""
-        
-        for i, result in enumerate(all_results):
-            problem_title = result['problem'].title
-            readme_content += f"- **Problem {i+1}**: {problem_title}\n"
-            readme_content += f"  - Directory: `problem_{i+1:02d}/`\n"
-            readme_content += f"  - Files: `explanation.json`, `slides.md`\n\n"
-        
-        readme_content += f"""
+""")
+        processed = 0
+        # Finished problems by position (None if they failed), written in problem order
+        finished = {}
+        next_readme = 0
+        
+        def finish_output(i: int, problem: Problem, future: Optional[Future]) -> None:
+            nonlocal processed, next_readme
+            if future is None:
+                # Generation for its batch failed, which is already logged
+                finished[i] = None
+            else:
+                try:
+                    future.result()
+                    finished[i] = problem
+                    processed += 1
+                    logging.info(f"Problem {i+1} completed successfully")
+                except Exception as e:
+                    logging.error(f"Failed to process problem {i+1}: {str(e)}")
+                    log_traceback()
+                    finished[i] = None
+            
+            while next_readme in finished:
+                done = finished.pop(next_readme)
+                if done is not None:
+                    readme_f.write(f"- **Problem {next_readme+1}**: {done.title}\n")
+                    readme_f.write(f"  - Directory: `problem_{next_readme+1:02d}/`\n")
+                    readme_f.write(f"  - Files: `explanation.json`, `slides.md`\n\n")
+                next_readme += 1
+        
+        # Responses are parsed and saved in worker threads while the next batch decodes
+        output_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+        pending_outputs = collections.deque()
+        with readme_f, output_pool:
+            for start in range(0, len(order), batch_size):
+                positions = order[start:start + batch_size]
+                batch = [problems[i] for i in positions]
+                batch_label = ', '.join(str(i + 1) for i in positions)
+                logging.info(f"Processing problems {batch_label} of {len(problems)}")
+                
+                try:
+                    # Generate responses for the whole batch
+                    batch_raws = generate_raw_responses(
+                        model, tokenizer, batch, args,
+                        cache=generation_cache,
+                        assistant_model=assistant_model,
+                        semantic_cache=semantic_cache,
+                    )
+                except Exception as e:
+                    logging.error(f"Failed to process problems {batch_label}: {str(e)}")
+                    log_traceback()
+                    for i, problem in zip(positions, batch):
+                        pending_outputs.append((i, problem, None))
+                    continue
+                
+                for i, problem, raw in zip(positions, batch, batch_raws):
+                    logging.info(f"Processing problem {i+1}/{len(problems)}: {problem.title}")
+                    problem_output_dir = os.path.join(args.output, f"problem_{i+1:02d}")
+                    pending_outputs.append((i, problem, output_pool.submit(
+                        save_problem_output, problem, args, raw, problem_output_dir
+                    )))
+                
+                # Record problems that have finished
+                while pending_outputs and (pending_outputs[0][2] is None or pending_outputs[0][2].done()):
+                    finish_output(*pending_outputs.popleft())
+            
+            while pending_outputs:
+                finish_output(*pending_outputs.popleft())
+            
+            if hasattr(generation_cache, 'close'):
+                generation_cache.close()
+            if semantic_cache is not None:
+                semantic_cache.close()
+            
+            readme_f.write(f"""Total problems processed: {processed}
+
 ## Usage Instructions
 
 1. **JSON Data**: Contains all generated content in structured format
@@ -2243,25 +3300,25 @@ Each problem has been processed and saved in its own directory:
 ## Model Configuration
 
 - Model: {args.model}
+- Engine: {args.engine}
+- Quantization: {args.quant}
 - Max New Tokens: {args.max_new_tokens}
 - Temperature: {args.temperature}
 - Top-p: {args.top_p}
+- Greedy Decoding: {args.greedy}
 - Device: {args.device}
+- Batch Size: {args.batch_size}
 
 Generated by AI Question Guide Generator
-"""
-        
-        readme_path = os.path.join(args.output, "README.md")
-        with open(readme_path, 'w', encoding='utf-8') as f:
-            f.write(readme_content)
+""")
         
         logging.info(f"Generation completed successfully!")
         logging.info(f"Results saved to: {args.output}")
-        logging.info(f"Total problems processed: {len(all_results)}")
+        logging.info(f"Total problems processed: {processed}")
         
     except Exception as e:
         logging.error(f"Fatal error in main execution: {str(e)}")
-        logging.error(traceback.format_exc())
+        log_traceback()
         sys.exit(1)
 
 if __name__ == "__main__":
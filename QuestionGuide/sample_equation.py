@@ -1,38 +1,168 @@
 from manim import *
+import functools
+import os
+import re
+import string
+
+from sympy import Eq, Symbol, expand, latex, solve, sstr
+from sympy.parsing.sympy_parser import (
+    convert_xor,
+    implicit_multiplication,
+    parse_expr,
+    standard_transformations,
+)
+
+# Implicit multiplication ("2x") without splitting names into single-letter products
+_TRANSFORMATIONS = standard_transformations + (implicit_multiplication, convert_xor)
+# Every single letter is a plain symbol, so E, I, N, S, ... are not SymPy builtins
+_LETTER_SYMBOLS = {letter: Symbol(letter) for letter in string.ascii_letters}
+_FIRST_LETTER_RE = re.compile(r'[a-zA-Z]')
+_WORD_RE = re.compile(r'[a-zA-Z]{2,}')
+
+# Keep compiled LaTeX across runs so re-renders skip the latex/dvisvgm passes
+config.tex_dir = os.path.join(os.path.expanduser("~"), ".cache", "manim", "Tex")
+# Same for Text: Pango layouts are written once per string, font and size
+config.text_dir = os.path.join(os.path.expanduser("~"), ".cache", "manim", "texts")
+
+
+def _plain(expr):
+    """Plain-text form of a SymPy term for the step captions."""
+    return sstr(expr, full_prec=False).replace("*", "")
+
+
+def _move_term(lhs, rhs, term):
+    """Step that removes ``term`` from both sides of ``lhs = rhs``."""
+    if term.could_extract_minus_sign():
+        explanation, op, shown = f"Add {_plain(-term)} to both sides", "+", -term
+    else:
+        explanation, op, shown = f"Subtract {_plain(term)} from both sides", "-", term
+    return {
+        "explanation": explanation,
+        "equation": f"{latex(lhs)} {op} {latex(shown)} = {latex(rhs)} {op} {latex(shown)}",
+    }
+
+
+@functools.lru_cache(maxsize=128)
+def _solve_steps(equation):
+    """
+    Solve ``equation`` with SymPy and return its steps as a tuple of dicts.
+    Results are cached on the whitespace-normalized equation string.
+    """
+    letter = _FIRST_LETTER_RE.search(equation)
+    name = letter.group(0) if letter else "x"
+    generic = (
+        {"explanation": "Isolate the variable term", "equation": equation},
+        {"explanation": f"Solve for {name}", "equation": f"{name} = ?"},
+    )
+    lhs_text, sep, rhs_text = equation.partition("=")
+    # Multi-letter names are prose or unknown functions ("Total apples = 12 + 8")
+    if not sep or _WORD_RE.search(equation):
+        return generic
+    try:
+        lhs = parse_expr(lhs_text, local_dict=dict(_LETTER_SYMBOLS), transformations=_TRANSFORMATIONS)
+        rhs = parse_expr(rhs_text, local_dict=dict(_LETTER_SYMBOLS), transformations=_TRANSFORMATIONS)
+    except Exception:
+        return generic
+    free = (lhs - rhs).free_symbols
+    if len(free) != 1:
+        return generic
+    (var,) = free
+
+    poly = expand(lhs - rhs).as_poly(var)
+    if poly is None or poly.degree() != 1:
+        try:
+            solutions = solve(Eq(lhs, rhs), var)
+        except Exception:
+            return generic
+        if not solutions:
+            return generic
+        return (
+            {"explanation": "Move all terms to one side", "equation": latex(Eq(expand(lhs - rhs), 0))},
+            {"explanation": "Solution", "equation": f"{latex(var)} = " + ", ".join(latex(s) for s in solutions)},
+        )
+
+    steps = []
+    if not lhs.has(var):
+        lhs, rhs = rhs, lhs
+    # Collect the variable terms on the left, then the constants on the right
+    var_terms = rhs.as_independent(var, as_Add=True)[1]
+    if var_terms != 0:
+        steps.append(_move_term(lhs, rhs, var_terms))
+        lhs, rhs = expand(lhs - var_terms), expand(rhs - var_terms)
+        steps.append({"explanation": "Simplify", "equation": f"{latex(lhs)} = {latex(rhs)}"})
+    constant = lhs.as_independent(var, as_Add=True)[0]
+    if constant != 0:
+        steps.append(_move_term(lhs, rhs, constant))
+        lhs, rhs = expand(lhs - constant), expand(rhs - constant)
+        steps.append({"explanation": "Simplify", "equation": f"{latex(lhs)} = {latex(rhs)}"})
+    coefficient = lhs.coeff(var)
+    if coefficient == 1:
+        if steps:
+            steps.pop()  # the last "Simplify" already reads var = value
+    elif coefficient.is_Rational and not coefficient.is_Integer:
+        reciprocal = latex(1 / coefficient)
+        steps.append({
+            "explanation": f"Multiply both sides by {_plain(1 / coefficient)}",
+            "equation": rf"{reciprocal} \cdot {latex(lhs)} = {reciprocal} \cdot {latex(rhs)}",
+        })
+    else:
+        steps.append({
+            "explanation": f"Divide both sides by {_plain(coefficient)}",
+            "equation": rf"\frac{{{latex(lhs)}}}{{{latex(coefficient)}}} = \frac{{{latex(rhs)}}}{{{latex(coefficient)}}}",
+        })
+    steps.append({"explanation": "Solution", "equation": f"{latex(var)} = {latex(rhs / coefficient)}"})
+    return tuple(steps)
+
 
 class Equation_7267(Scene):
+    # Prebuilt mobjects keyed on source and size; the scene only ever adds copies
+    _tex_cache = {}
+
+    @classmethod
+    def _get_mathtex(cls, tex, scale):
+        key = ("tex", tex, scale)
+        if key not in cls._tex_cache:
+            cls._tex_cache[key] = MathTex(tex).scale(scale)
+        return cls._tex_cache[key].copy()
+
+    @classmethod
+    def _get_text(cls, text, font_size):
+        key = ("text", text, font_size)
+        if key not in cls._tex_cache:
+            cls._tex_cache[key] = Text(text, font_size=font_size)
+        return cls._tex_cache[key].copy()
+
     def construct(self):
+        # Solve and build every step mobject before the first play, so the LaTeX
+        # compiles are not interleaved with the animations
+        steps = self.solve_equation("2x + 5 = 15")
+        equations = [self._get_mathtex(step["equation"], 1.5) for step in steps]
+        explanations = [self._get_text(step["explanation"], 24) for step in steps]
+        
         # Title
-        title = Text("Solving: 2x + 5 = 15", font_size=36)
+        title = self._get_text("Solving: 2x + 5 = 15", 36)
         title.to_edge(UP)
         self.play(Write(title))
         self.wait(1)
         
         # Original equation
-        eq1 = MathTex(r"2x + 5 = 15")
-        eq1.scale(1.5)
+        eq1 = self._get_mathtex(r"2x + 5 = 15", 1.5)
         self.play(Write(eq1))
         self.wait(2)
         
         # Step-by-step solution
-        steps = self.solve_equation("2x + 5 = 15")
-        
         current_eq = eq1
-        for i, step in enumerate(steps):
-            # Move current equation up
-            self.play(current_eq.animate.shift(UP * 1.5))
-            
-            # Show step explanation
-            explanation = Text(step["explanation"], font_size=24)
-            explanation.next_to(current_eq, DOWN, buff=0.5)
-            self.play(Write(explanation))
-            self.wait(1)
-            
-            # Show new equation
-            new_eq = MathTex(step["equation"])
-            new_eq.scale(1.5)
+        for i, (explanation, new_eq) in enumerate(zip(explanations, equations)):
+            # Lay out against where the current equation ends up, then move it up
+            # and write the explanation and the new equation in one play
+            explanation.next_to(current_eq, DOWN, buff=0.5).shift(UP * 1.5)
             new_eq.next_to(explanation, DOWN, buff=0.5)
-            self.play(Write(new_eq))
+            self.play(AnimationGroup(
+                current_eq.animate.shift(UP * 1.5),
+                Write(explanation),
+                Write(new_eq),
+                lag_ratio=0.5,
+            ))
             self.wait(2)
             
             # Clean up for next step
@@ -50,26 +180,7 @@ class Equation_7267(Scene):
         Parse and solve the equation step by step.
         Returns a list of steps with explanations.
         """
-        steps = []
-        
-        # Simple linear equation solver for demonstration
-        # This is a basic implementation - could be enhanced with sympy
-        
-        if "2x + 5 = 15" in equation:
-            steps = [
-                {"explanation": "Subtract 5 from both sides", "equation": r"2x + 5 - 5 = 15 - 5"},
-                {"explanation": "Simplify", "equation": r"2x = 10"},
-                {"explanation": "Divide both sides by 2", "equation": r"\frac{2x}{2} = \frac{10}{2}"},
-                {"explanation": "Solution", "equation": r"x = 5"}
-            ]
-        else:
-            # Generic steps for other equations
-            steps = [
-                {"explanation": "Isolate the variable term", "equation": equation},
-                {"explanation": "Solve for x", "equation": f"x = ?"}
-            ]
-        
-        return steps
+        return [dict(step) for step in _solve_steps(" ".join(equation.split()))]
 
 # To render this animation, run:
 # manim -pql sample_equation.py Equation_7267
\ No newline at end of file
@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""
+Tests for the questionguide response parsing and generation helpers
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+# questionguide imports torch and transformers at module level
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+# Add the current directory to the path
+sys.path.append(str(Path(__file__).parent))
+
+import questionguide as qg
+
+SAMPLE_RESPONSE = """## Overview
+This problem asks us to find a missing number in an addition sentence. We work backwards from the total.
+
+## Solution
+Start with 2x + 5 = 15. Subtract 5 from both sides to get 2x = 10. Divide by 2.
+
+## Final Answer
+- x = 5
+
+## Common Mistakes
+- Forgetting to subtract 5 from both sides
+- Dividing only one side by 2
+
+## Practice Problems
+1. Solve 3x + 4 = 19
+2. Solve 5x - 2 = 13
+"""
+
+
+def test_parse_markdown_response_sections():
+    """Each section of a representative response lands in its field"""
+    data = qg.parse_markdown_response(SAMPLE_RESPONSE, "2x + 5 = 15")
+
+    assert data["overview"] == [
+        "This problem asks us to find a missing number in an addition sentence.",
+        "We work backwards from the total.",
+    ]
+    assert data["solution"] == (
+        "Start with 2x + 5 = 15. Subtract 5 from both sides to get 2x = 10. Divide by 2."
+    )
+    assert data["final_answer"] == "x = 5"
+    assert data["mistakes"] == [
+        "Forgetting to subtract 5 from both sides",
+        "Dividing only one side by 2",
+    ]
+    assert data["practice"] == ["Solve 3x + 4 = 19", "Solve 5x - 2 = 13"]
+    assert data["problem_text"] == "2x + 5 = 15"
+
+
+@pytest.mark.parametrize("answer", ["**14**", "*x = 5*", "-3"])
+def test_parse_markdown_response_keeps_answer_markup(answer):
+    """Bold/italic markup and minus signs are not mistaken for a bullet"""
+    data = qg.parse_markdown_response(f"## Final Answer\n{answer}\n")
+    assert data["final_answer"] == answer
+
+
+class StubEncoder:
+    """Sentence-transformers stand-in returning fixed vectors per text"""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def get_sentence_embedding_dimension(self):
+        return 3
+
+    def encode(self, texts, normalize_embeddings=True, convert_to_numpy=True):
+        np = pytest.importorskip("numpy")
+        rows = np.array([self.vectors[text] for text in texts], dtype=np.float64)
+        return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+STUB_VECTORS = {
+    "Solve 2x + 5 = 15": [1.0, 0.0, 0.0],
+    "Solve 2x + 5 = 15.": [1.0, 0.1, 0.0],    # cosine ~0.995 to the first problem
+    "Solve 2x + 7 = 15": [1.0, 0.5, 0.0],     # cosine ~0.894
+    "Name three prime numbers": [0.0, 0.0, 1.0],
+}
+
+
+def make_semantic_cache(directory, threshold=0.95):
+    pytest.importorskip("numpy")
+    return qg.SemanticCache(str(directory), "semcache_test", threshold=threshold,
+                            encoder=StubEncoder(STUB_VECTORS))
+
+
+def test_semantic_cache_threshold(tmp_path):
+    """Only problems at or above the similarity threshold reuse a response"""
+    cache = make_semantic_cache(tmp_path)
+    texts = list(STUB_VECTORS)
+    assert cache.lookup(cache.embed(texts)) == [None] * len(texts)
+
+    cache.add(cache.embed(["Solve 2x + 5 = 15"]), ["RAW 2x+5"])
+    assert cache.lookup(cache.embed(texts)) == ["RAW 2x+5", "RAW 2x+5", None, None]
+
+    strict = make_semantic_cache(tmp_path / "strict", threshold=0.999)
+    strict.add(strict.embed(["Solve 2x + 5 = 15"]), ["RAW 2x+5"])
+    assert strict.lookup(strict.embed(["Solve 2x + 5 = 15."])) == [None]
+
+
+def test_semantic_cache_persistence(tmp_path):
+    """Entries survive close() and reload; a truncated sidecar is trimmed to match"""
+    cache = make_semantic_cache(tmp_path)
+    cache.add(cache.embed(["Solve 2x + 5 = 15", "Name three prime numbers"]), ["RAW A", "RAW B"])
+    cache.close()
+
+    reloaded = make_semantic_cache(tmp_path)
+    assert reloaded.raws == ["RAW A", "RAW B"]
+    assert reloaded.lookup(reloaded.embed(["Solve 2x + 5 = 15.", "Name three prime numbers"])) == ["RAW A", "RAW B"]
+
+    entries = tmp_path / "semcache_test.jsonl"
+    entries.write_text(entries.read_text(encoding="utf-8").splitlines()[0] + "\n", encoding="utf-8")
+    trimmed = make_semantic_cache(tmp_path)
+    assert trimmed.raws == ["RAW A"]
+    assert len(trimmed.vectors) == 1
+
+
+def test_generate_raw_responses_semantic_cache(tmp_path, monkeypatch):
+    """Near-duplicates reuse a response; dissimilar problems are generated"""
+    prompts = []
+
+    def fake_chat_completion(model, tokenizer, messages_batch, **kwargs):
+        prompts.extend(messages[-1]["content"] for messages in messages_batch)
+        return [f"RAW {len(prompts) - len(messages_batch) + i}" for i in range(len(messages_batch))]
+
+    monkeypatch.setattr(qg, "chat_completion", fake_chat_completion)
+    cache = make_semantic_cache(tmp_path)
+    args = type("Args", (), {"engine": "hf"})()
+
+    first = qg.generate_raw_responses(None, None, [qg.Problem("1", "Solve 2x + 5 = 15", 1)], args,
+                                      semantic_cache=cache)
+    second = qg.generate_raw_responses(None, None, [
+        qg.Problem("2", "Solve 2x + 5 = 15.", 2),
+        qg.Problem("3", "Solve 2x + 7 = 15", 3),
+    ], args, semantic_cache=cache)
+
+    assert first == ["RAW 0"]
+    assert second == ["RAW 0", "RAW 1"]
+    assert len(prompts) == 2 and "2x + 7" in prompts[1]
+
+
+def build_tiny_chat_model():
+    """Random two-layer Llama with a byte-level tokenizer and a minimal chat template"""
+    import torch
+    tokenizers = pytest.importorskip("tokenizers")
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    vocab = {c: i for i, c in enumerate(sorted(tokenizers.pre_tokenizers.ByteLevel.alphabet()))}
+    for special in ("<s>", "</s>", "<pad>"):
+        vocab[special] = len(vocab)
+    backend = tokenizers.Tokenizer(tokenizers.models.BPE(vocab=vocab, merges=[]))
+    backend.pre_tokenizer = tokenizers.pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = tokenizers.decoders.ByteLevel()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=backend, bos_token="<s>", eos_token="</s>",
+                                        pad_token="<pad>", padding_side="left")
+    tokenizer.chat_template = (
+        "{% for m in messages %}<s>{{ m['role'] }}: {{ m['content'] }}\n{% endfor %}"
+        "{% if add_generation_prompt %}<s>assistant: {% endif %}"
+    )
+
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=len(vocab), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=4096,
+                         bos_token_id=vocab["<s>"], eos_token_id=vocab["</s>"], pad_token_id=vocab["<pad>"])
+    return LlamaForCausalLM(config).eval(), tokenizer
+
+
+def test_shared_prefix_cache_matches_uncached_generation():
+    """Generating from the prefilled system-turn cache gives the same tokens as a full prefill"""
+    import torch
+    model, tokenizer = build_tiny_chat_model()
+
+    for question in ("Solve 2x + 5 = 15", "What is 7 * 8?", "Explain fractions"):
+        messages = qg.explanation_prompt(question, "middle school")
+        input_ids = qg.encode_chat(tokenizer, messages)
+        generate_kwargs = dict(input_ids=torch.tensor([input_ids]), attention_mask=torch.ones(1, len(input_ids), dtype=torch.long),
+                               max_new_tokens=24, do_sample=False, pad_token_id=tokenizer.pad_token_id)
+
+        prefix_cache = qg._shared_prefix_cache(model, tokenizer, messages, input_ids)
+        assert prefix_cache is not None
+        prefix_length = prefix_cache.get_seq_length()
+        with torch.no_grad():
+            cached = model.generate(**generate_kwargs, past_key_values=prefix_cache)
+            uncached = model.generate(**generate_kwargs)
+        # generate extended the prefilled cache instead of replacing it
+        assert 0 < prefix_length < prefix_cache.get_seq_length()
+        assert cached.tolist() == uncached.tolist()
+
+        # The shared cache is copied per call, so a second run is unaffected by the first
+        with torch.no_grad():
+            again = model.generate(**generate_kwargs,
+                                   past_key_values=qg._shared_prefix_cache(model, tokenizer, messages, input_ids))
+        assert again.tolist() == uncached.tolist()
+
+
+def load_scene_solver():
+    """Execute the generated-scene prelude without manim and return its step solver"""
+    pytest.importorskip("sympy")
+    namespace = {"config": type("Config", (), {})()}
+    exec(qg._MANIM_SCENE_PRELUDE, namespace)
+    return namespace["_solve_steps"]
+
+
+def test_scene_solver_linear_steps():
+    """The worked example keeps its four classic steps"""
+    solve_steps = load_scene_solver()
+    assert list(solve_steps("2x + 5 = 15")) == [
+        {"explanation": "Subtract 5 from both sides", "equation": "2 x + 5 - 5 = 15 - 5"},
+        {"explanation": "Simplify", "equation": "2 x = 10"},
+        {"explanation": "Divide both sides by 2", "equation": r"\frac{2 x}{2} = \frac{10}{2}"},
+        {"explanation": "Solution", "equation": "x = 5"},
+    ]
+
+
+@pytest.mark.parametrize("equation, name", [
+    ("so 2x + 5 = 15", "s"),
+    ("Total apples = 12 + 8", "T"),
+    ("2x + y = 5", "x"),
+    ("2 + 2 = 4", "x"),
+])
+def test_scene_solver_prose_falls_back(equation, name):
+    """Prose, several unknowns or no unknown get the generic steps instead of a derivation"""
+    solve_steps = load_scene_solver()
+    assert list(solve_steps(equation)) == [
+        {"explanation": "Isolate the variable term", "equation": equation},
+        {"explanation": f"Solve for {name}", "equation": f"{name} = ?"},
+    ]
+
+
+def test_generation_cache_key_covers_settings():
+    """Changing the model, prompt or decoding settings never reuses a cached response"""
+    from argparse import Namespace
+    base = dict(model="m", engine="hf", quant="none", grade_level="middle school",
+                greedy=False, temperature=0.7, top_p=0.9, max_new_tokens=1024)
+    key = qg.generation_cache_key("Solve 2x + 5 = 15", Namespace(**base))
+    assert key == qg.generation_cache_key("Solve 2x + 5 = 15", Namespace(**base))
+    assert key != qg.generation_cache_key("Solve 2x + 7 = 15", Namespace(**base))
+    for change in (dict(model="n"), dict(quant="int4"), dict(grade_level="high school"),
+                   dict(greedy=True), dict(temperature=0.2), dict(top_p=0.5), dict(max_new_tokens=2048)):
+        assert key != qg.generation_cache_key("Solve 2x + 5 = 15", Namespace(**{**base, **change})), change
+    # Sampling parameters do not matter for greedy decoding
+    greedy = Namespace(**{**base, "greedy": True})
+    assert qg.generation_cache_key("x", greedy) == qg.generation_cache_key(
+        "x", Namespace(**{**base, "greedy": True, "temperature": 0.1}))
+
+
+def test_parse_markdown_problems_headings():
+    """Headings split problems; whitespace-only and unspaced '#' lines stay in the body"""
+    content = ("Preamble\n# Problem 1\nSolve 2x + 5 = 15\n#  \nstill problem 1\n"
+               "## Problem 2: Fractions\nAdd 1/2 and 1/3\n#not a heading\n")
+    problems = qg.parse_markdown_problems(content)
+    assert [(p.title, p.content, p.index) for p in problems] == [
+        ("Problem 1", "Solve 2x + 5 = 15\n#  \nstill problem 1", 1),
+        ("Problem 2: Fractions", "Add 1/2 and 1/3\n#not a heading", 2),
+    ]
+
+
+def test_parse_markdown_response_drops_header_lines():
+    """Section bodies start after the header line even when blank lines precede it"""
+    data = qg.parse_markdown_response("Intro line\n\n\n## Solution\nSubtract 5.\n\n\n### Final Answer:\nx = 5\n")
+    assert data["solution"] == "Subtract 5."
+    assert data["final_answer"] == "x = 5"
+
+
+@pytest.mark.parametrize("solution, steps", [
+    ("Step 1: Subtract 5.\nStep 2: Divide by 2.", ["Subtract 5.", "Divide by 2."]),
+    # Numbers inside a step are not markers
+    ("1. Add 3 and 4 to get 7.\n2. Double it to get 14.", ["Add 3 and 4 to get 7.", "Double it to get 14."]),
+    # "Step N:" markers win over numbered lines nested in a step
+    ("Step 1: Set up\n1. a\n2. b\nStep 2: Solve", ["Set up\n1. a\n2. b", "Solve"]),
+    ("- First idea\n  continued\n- Second idea", ["First idea\n  continued", "Second idea"]),
+    # A single marker is not enough; markers only count at the start of a line
+    ("Answer is 7.\nStep 1: only one", ["Answer is 7.\nStep 1: only one"]),
+    ("First paragraph.\n\nSecond paragraph.", ["First paragraph.", "Second paragraph."]),
+    ("Just one step", ["Just one step"]),
+])
+def test_split_steps(solution, steps):
+    assert qg._split_steps(solution) == steps
+
+
+@pytest.mark.parametrize("step, operation", [
+    ("Add 3 and 4 to get 7", "addition"),
+    ("Subtract 5 from both sides", "subtraction"),
+    ("Multiply 3 times 4", "multiplication"),
+    ("Divide 10 by 2", "division"),
+    ("Solve the equation for x", "solving"),
+    ("Write the answer", "generic"),
+    # The first matching operation in table order wins
+    ("Find the total of 12 and 8", "addition"),
+    ("Share 12 equally among 3 groups", "multiplication"),
+])
+def test_create_step_diagram_dispatch(step, operation, monkeypatch):
+    """Each step goes to the renderer of the first operation whose keyword it contains"""
+    for name in qg._OP_RENDERERS:
+        monkeypatch.setitem(qg._OP_RENDERERS, name, lambda numbers, step_number, name=name: f"<{name}:{numbers}>")
+    html = qg.create_step_diagram.__wrapped__(step, 2)
+    assert f"<{operation}:" in html
+    assert step in html
+
+
+FALLBACK_RESPONSE = """Intro text
+
+## Overview
+- Find the unknown number
+- Use inverse operations
+
+## Solution
+Subtract 5, then divide by 2.
+
+## Final Answer
+x = 5
+
+## Common Mistakes
+🚫 - Adding 5 instead of subtracting
+🚫 Forgetting to divide
+
+## Practice Problems
+📝 - Solve 3x + 1 = 10
+📝 Solve x + 4 = 9
+"""
+
+
+def test_extract_markdown_fallback_sections():
+    data = qg.extract_markdown_fallback(FALLBACK_RESPONSE, "2x + 5 = 15")
+    assert data["overview"] == ["Find the unknown number", "Use inverse operations"]
+    assert data["solution"] == "Subtract 5, then divide by 2."
+    assert data["final_answer"] == "x = 5"
+    assert data["mistakes"] == ["Adding 5 instead of subtracting", "Forgetting to divide"]
+    assert data["practice"] == ["Solve 3x + 1 = 10", "Solve x + 4 = 9"]
+
+
+def test_extract_markdown_fallback_first_mention_wins():
+    """Section names match anywhere, as the old per-section searches did"""
+    data = qg.extract_markdown_fallback("The final answer section is below\n## Final Answer\n7\n")
+    assert data["final_answer"] == "section is below"
+
+
+@pytest.mark.parametrize("text, expected", [
+    # The longest balanced object wins; braces inside strings do not count
+    ('text {"a": 1} more {"b": {"c": "}"}, "d": "{"} end', '{"b": {"c": "}"}, "d": "{"}'),
+    ('{"a": "x\\"}"}', '{"a": "x\\"}"}'),
+    ('{"open": 1', None),
+    ("no json here", None),
+])
+def test_extract_balanced_json(text, expected):
+    assert qg._extract_balanced_json(text) == expected
+
+
+def test_construct_json_from_text_list_items():
+    """Bulleted and numbered items are split line by line"""
+    data = json.loads(qg.construct_json_from_text(
+        "**Step-by-Step Solution:**\nSubtract 5 then divide.\n\n"
+        "**Common Mistakes:**\n- Forgetting to subtract\n* Dividing one side only\n1. Mixing up signs\n\n"
+        "**Practice Problems:**\n1. Solve 3x = 9\n- Solve x + 2 = 5\n"
+    ))
+    assert data["solution"] == "Subtract 5 then divide."
+    assert data["mistakes"] == ["🚫 Forgetting to subtract", "🚫 Dividing one side only", "🚫 Mixing up signs"]
+    assert data["practice"] == ["📝 Solve 3x = 9", "📝 Solve x + 2 = 5"]
+
+
+def test_clean_json_text_escapes_only_inside_strings():
+    """Raw newlines/tabs in values are escaped; layout whitespace and trailing commas are fixed"""
+    cleaned = qg.clean_json_text('Here you go:\n{\n  "solution": "a\tb\nc",\n  "x": [1, 2,]\n}\nThanks')
+    assert cleaned == '{\n  "solution": "a\\tb\\nc",\n  "x": [1, 2]\n}'
+    assert json.loads(cleaned) == {"solution": "a\tb\nc", "x": [1, 2]}
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ('Here:\n```json\n{"solution": "x = 5", "final_answer": "5"}\n```', {"solution": "x = 5", "final_answer": "5"}),
+    # Recovered by clean_json_text
+    ("{'solution': 'x = 5',}", {"solution": "x = 5"}),
+    ('{"solution": "line one\nline two",\n "final_answer": "5"}', {"solution": "line one\nline two", "final_answer": "5"}),
+    # Objects without a solution and brace-free text are rejected
+    ('{"overview": ["a"]}', None),
+    ("no braces", None),
+])
+def test_try_json_parse(raw, expected):
+    assert qg._try_json_parse(raw, qg.Problem("t", "c", 1)) == expected
+
+
+def test_parse_fenced_problems():
+    content = (
+        "Intro\n```problem\nSolve 2x + 5 = 15\n```\ntext between\n"
+        "```math\nCompute 7 * 8\n```\n```question\n```\n```problem\nUnclosed"
+    )
+    problems = qg.parse_fenced_problems(content)
+    # Empty and unclosed blocks are skipped; numbering only counts kept problems
+    assert [(p.title, p.content, p.index) for p in problems] == [
+        ("Problem 1", "Solve 2x + 5 = 15", 1),
+        ("Math 2", "Compute 7 * 8", 2),
+    ]
+
+
+def test_parse_paragraph_problems_titles():
+    content = (
+        "Solve 2x + 5 = 15.\nShow work.\n\nWhat is 7 * 8?\n\n  \n\n"
+        "A very long first line " + "x" * 120 + "\nsecond"
+    )
+    problems = qg.parse_paragraph_problems(content)
+    # Short first lines become titles; blank paragraphs are dropped
+    assert [p.title for p in problems] == ["Solve 2x + 5 = 15.", "What is 7 * 8?", "Problem 3"]
+    assert problems[0].content == "Solve 2x + 5 = 15.\nShow work."
+
+
+def test_manim_script_footer_names_recorded_file():
+    entries = qg.build_manim_scripts("Solve 2x + 5 = 15 for x.")
+    assert entries
+    for entry in entries:
+        class_name = entry["filename"][:-len(".py")].capitalize()
+        assert f"class {class_name}(Scene):" in entry["script"]
+        assert entry["script"].rstrip().endswith(f"# manim -pql {entry['filename']} {class_name}")
+
+
+def test_read_docx_content_nested_runs():
+    # Fixture holds a tracked insertion and deletion, a smart tag, inline and block-level
+    # content controls, simple and complex fields, and a table
+    content = qg.read_docx_content(Path(__file__).parent / "docx_constructs.docx")
+    assert content.split("\n\n") == [
+        "# Problem 1",
+        "Solve 2x + 5 = 15 for x.",
+        "Name: Ada",
+        "Page 3 of 4",
+        "# Problem 2",
+        "What is 7 * 8?",
+    ]